@@ -1,10 +1,28 @@
 """Interface definition and common implemetations for embedding classes"""
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import schema
+from log_configs import log
 
 # pylint: disable=too-few-public-methods, unused-argument
+EXECUTOR_WORKERS = int(os.getenv("EMBEDDING_EXECUTOR_WORKERS", "4"))
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Bounded thread pool on which blocking embedding calls are run for async callers"""
+    global _EXECUTOR  # pylint: disable=global-statement
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(
+                max_workers=EXECUTOR_WORKERS, thread_name_prefix="embedding"
+            )
+        return _EXECUTOR
 
 
 class EmbeddingInterface:
@@ -12,6 +30,7 @@ class EmbeddingInterface:
 
     api_key: str
     api_object = None
+    model_name: str = None
 
     def __init__(self, key: str, **kwargs) -> None:
         """Sets the API key and initializes library objects if any"""
@@ -20,3 +39,44 @@ class EmbeddingInterface:
     def get_embeddings(self, doc_list: List[schema.Document]) -> None:
         """Generate embedding for the .text values and sets them to .embedding field of i/p items"""
         return
+
+    async def aget_embeddings(self, doc_list: List[schema.Document]) -> None:
+        """Awaitable get_embeddings. Implementations without a native async API
+        are run on the bounded embedding executor, off the event loop"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(get_executor(), self.get_embeddings, doc_list)
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Vectors for a list of query texts, generated as one batch"""
+        docs = [
+            schema.Document(docId=str(num), text=query)
+            for num, query in enumerate(queries)
+        ]
+        self.get_embeddings(doc_list=docs)
+        return [doc.embedding for doc in docs]
+
+
+# Vector sizes of the models we use, so that they needn't be found out by embedding a text
+KNOWN_DIMENSIONS = {
+    "thenlper/gte-small": 384,
+    "sentence-transformers/LaBSE": 768,
+    "text-embedding-ada-002": 1536,
+}
+_probed_dimensions = {}
+_probe_lock = threading.Lock()
+
+
+def get_embedding_dimension(embedding: EmbeddingInterface) -> int:
+    """Vector size for the embedding's model, from the known table or by embedding
+    a dummy text once per model per process"""
+    model_name = str(embedding.model_name).split(":", maxsplit=1)[0]
+    if model_name in KNOWN_DIMENSIONS:
+        return KNOWN_DIMENSIONS[model_name]
+    key = (type(embedding).__name__, embedding.model_name)
+    with _probe_lock:
+        if key not in _probed_dimensions:
+            test_doc = schema.Document(docId="test", text="test")
+            embedding.get_embeddings([test_doc])
+            _probed_dimensions[key] = len(test_doc.embedding)
+            log.info("Probed embedding dimension for %s: %s", key, _probed_dimensions[key])
+        return _probed_dimensions[key]
@@ -0,0 +1,143 @@
+"""Dynamic micro-batching of query embeddings from concurrent requests"""
+import os
+import time
+import queue
+import asyncio
+import weakref
+import threading
+from concurrent.futures import Future
+from typing import List
+
+import schema
+from core.embedding import EmbeddingInterface
+from log_configs import log
+
+MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+# A batcher's worker thread stops after this long without requests
+IDLE_SECONDS = float(os.getenv("EMBEDDING_BATCH_IDLE_SECONDS", "60"))
+
+
+class EmbeddingBatcher:
+    """Collects embedding requests for up to max_wait_ms, encodes them as one batch
+    and resolves the future of each caller with its own vector"""
+
+    def __init__(
+        self,
+        embedding: EmbeddingInterface,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_ms: float = MAX_WAIT_MS,
+        idle_seconds: float = IDLE_SECONDS,
+    ) -> None:
+        """Sets the backend and the batching knobs. The worker thread starts on first use
+        and stops when idle, to be started again by the next request"""
+        self.embedding = embedding
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.idle_seconds = max(0.0, idle_seconds)
+        self.requests = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        """Queues a text and returns a future for its vector"""
+        future = Future()
+        self.requests.put((text, future))
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(
+                    target=self._run, name="embedding-batcher", daemon=True
+                )
+                self.worker.start()
+        return future
+
+    def embed(self, text: str) -> List[float]:
+        """Blocking call that returns the vector for one text"""
+        return self.submit(text).result()
+
+    async def aembed(self, text: str) -> List[float]:
+        """Awaitable version of embed"""
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _collect(self) -> list:
+        """Waits for one request, then gathers more till the batch is full or the wait is over.
+        Returns an empty batch if no request came in idle_seconds"""
+        try:
+            batch = [self.requests.get(timeout=self.idle_seconds)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self.requests.get_nowait())
+                else:
+                    batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        """Worker loop"""
+        while True:
+            batch = self._collect()
+            if not batch:
+                with self.lock:
+                    # submit queues before it checks for the worker, under this lock
+                    if self.requests.empty():
+                        self.worker = None
+                        return
+                continue
+            docs = [
+                schema.Document(docId=str(num), text=text)
+                for num, (text, _) in enumerate(batch)
+            ]
+            try:
+                self.embedding.get_embeddings(doc_list=docs)
+            except Exception as exe:  # pylint: disable=broad-exception-caught
+                for _, future in batch:
+                    future.set_exception(exe)
+                continue
+            log.debug("Embedded a batch of %s queries", len(batch))
+            for doc, (_, future) in zip(docs, batch):
+                future.set_result(doc.embedding)
+
+
+# Held weakly, so a batcher and its embedding go once its worker has stopped
+# and no request is using it
+_BATCHERS = weakref.WeakValueDictionary()
+_BATCHERS_LOCK = threading.Lock()
+SETTING_TYPES = (str, int, float, bool, type(None))
+
+
+def batcher_key(embedding: EmbeddingInterface) -> tuple:
+    """The wrapper types around the backend, like CachedEmbedding, and the backend's type
+    and settings, such as its model, API key and batch size"""
+    wrappers = []
+    while isinstance(getattr(embedding, "embedding", None), EmbeddingInterface):
+        wrappers.append(type(embedding).__name__)
+        embedding = embedding.embedding
+    settings = sorted(
+        (name, value)
+        for name, value in vars(embedding).items()
+        if isinstance(value, SETTING_TYPES)
+    )
+    return (
+        tuple(wrappers),
+        type(embedding).__name__,
+        embedding.model_name,
+        tuple(settings),
+    )
+
+
+def get_batcher(embedding: EmbeddingInterface) -> EmbeddingBatcher:
+    """Returns the batcher shared by all embedding objects with the same backend settings,
+    so that queries from different sessions land in the same batch"""
+    key = batcher_key(embedding)
+    with _BATCHERS_LOCK:
+        batcher = _BATCHERS.get(key)
+        if batcher is None:
+            batcher = EmbeddingBatcher(embedding)
+            _BATCHERS[key] = batcher
+        return batcher
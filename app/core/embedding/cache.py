@@ -0,0 +1,231 @@
+"""Content-addressed embedding cache, shared by all embedding implementations"""
+import os
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+import schema
+from core.embedding import EmbeddingInterface, get_executor
+from log_configs import log
+
+# pylint: disable=too-few-public-methods, super-init-not-called
+CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+# A relative EMBEDDING_CACHE_DIR is taken from the app folder, not the working directory
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CACHE_DIR = os.path.join(APP_DIR, os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache"))
+CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024"))
+CACHE_MEMORY_ITEMS = int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "10000"))
+
+
+def normalize_text(text: str) -> str:
+    """Collapses whitespace, so that formatting-only edits map to the same entry"""
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """Two-tier vector store keyed by (model name, text hash).
+    Vectors are kept in a bounded in-memory LRU and as raw float32 files on disk"""
+
+    def __init__(
+        self,
+        path: str = CACHE_DIR,
+        max_disk_bytes: int = CACHE_MAX_MB * 1024 * 1024,
+        memory_items: int = CACHE_MEMORY_ITEMS,
+    ) -> None:
+        """Prepares the cache folder and finds out how much of the size cap is used"""
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+        os.makedirs(self.path, exist_ok=True)
+        self.disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """The content address of a text for a given model"""
+        digest = hashlib.sha256()
+        digest.update(str(model_name).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(normalize_text(text).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _file_path(self, key: str) -> str:
+        """Entries are sharded by the first two hex digits to keep folders small"""
+        return os.path.join(self.path, key[:2], key + ".f32")
+
+    def _disk_entries(self):
+        """Yields (path, mtime, size) for every vector file on disk"""
+        for folder, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(".f32"):
+                    continue
+                file_path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                yield file_path, stat.st_mtime, stat.st_size
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        """Adds to the memory tier, dropping the least recently used entry if full"""
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Returns the cached vector or None"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.memory[key]
+        file_path = self._file_path(key)
+        try:
+            vector = np.fromfile(file_path, dtype=np.float32)
+            os.utime(file_path)  # mtime is used as the recency for disk eviction
+        except (FileNotFoundError, ValueError):
+            with self.lock:
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self.stats["disk_hits"] += 1
+            self._remember(key, vector)
+        return vector
+
+    def put(self, key: str, vector) -> None:
+        """Stores a vector in both tiers"""
+        vector = np.asarray(vector, dtype=np.float32)
+        file_path = self._file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        vector.tofile(tmp_path)
+        try:
+            replaced_bytes = os.stat(file_path).st_size
+        except FileNotFoundError:
+            replaced_bytes = 0
+        os.replace(tmp_path, file_path)
+        with self.lock:
+            self._remember(key, vector)
+            # An overwritten entry only changes the size by the difference
+            self.disk_bytes += vector.nbytes - replaced_bytes
+            over_limit = self.disk_bytes > self.max_disk_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self) -> None:
+        """Deletes the least recently used files till the disk tier is at 90% of its cap"""
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        target = self.max_disk_bytes * 0.9
+        evicted = 0
+        for file_path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self.lock:
+            self.disk_bytes = total
+            self.stats["evictions"] += evicted
+        log.info("Evicted %s entries from the embedding cache", evicted)
+
+    def get_stats(self) -> dict:
+        """Hit/miss counters and current sizes"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_items"] = len(self.memory)
+            stats["disk_bytes"] = self.disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        )
+        return stats
+
+
+_DEFAULT_CACHE = None
+_DEFAULT_CACHE_LOCK = threading.Lock()
+
+
+def get_default_cache() -> EmbeddingCache:
+    """The process wide cache instance, created on first use"""
+    global _DEFAULT_CACHE  # pylint: disable=global-statement
+    with _DEFAULT_CACHE_LOCK:
+        if _DEFAULT_CACHE is None:
+            _DEFAULT_CACHE = EmbeddingCache()
+        return _DEFAULT_CACHE
+
+
+class CachedEmbedding(EmbeddingInterface):
+    """Wraps any embedding implementation, so that only texts not seen before
+    for the same model reach the actual backend"""
+
+    def __init__(
+        self, embedding: EmbeddingInterface, cache: Optional[EmbeddingCache] = None
+    ) -> None:
+        """Sets the backend and the cache to be used in front of it"""
+        self.embedding = embedding
+        self.model_name = embedding.model_name or type(embedding).__name__
+        self.cache = cache if cache is not None else get_default_cache()
+
+    def get_embeddings(self, doc_list: List[schema.Document]) -> None:
+        """Sets cached vectors, and generates the rest with the wrapped backend"""
+        misses = self._set_cached(doc_list)
+        if misses:
+            self.embedding.get_embeddings(doc_list=[docs[0] for docs in misses.values()])
+            self._store(misses)
+        self._log_stats(len(misses), len(doc_list))
+
+    async def aget_embeddings(self, doc_list: List[schema.Document]) -> None:
+        """Awaitable get_embeddings. The cache's file reads and writes
+        are run on the embedding executor, off the event loop"""
+        loop = asyncio.get_running_loop()
+        misses = await loop.run_in_executor(get_executor(), self._set_cached, doc_list)
+        if misses:
+            await self.embedding.aget_embeddings(
+                [docs[0] for docs in misses.values()]
+            )
+            await loop.run_in_executor(get_executor(), self._store, misses)
+        self._log_stats(len(misses), len(doc_list))
+
+    def _set_cached(self, doc_list: List[schema.Document]) -> dict:
+        """Sets the vectors found in cache and returns the other documents, grouped by key"""
+        misses = {}
+        for doc in doc_list:
+            key = self.cache.make_key(self.model_name, doc.text)
+            vector = self.cache.get(key)
+            if vector is not None:
+                doc.embedding = vector
+            else:
+                misses.setdefault(key, []).append(doc)
+        return misses
+
+    def _store(self, misses: dict) -> None:
+        """Caches the newly generated vectors and copies them to duplicate texts"""
+        for key, docs in misses.items():
+            self.cache.put(key, docs[0].embedding)
+            for doc in docs[1:]:
+                doc.embedding = docs[0].embedding
+
+    def _log_stats(self, num_misses: int, num_docs: int) -> None:
+        """Debug log of how effective the cache was"""
+        log.debug(
+            "Embedding cache: %s of %s documents needed embedding. Stats: %s",
+            num_misses,
+            num_docs,
+            self.cache.get_stats(),
+        )
@@ -1,14 +1,30 @@
 """Implemetations for embedding interface"""
 import os
+import time
+import asyncio
 from typing import List, Optional
 import openai
+import tiktoken
 
 import schema
 from core.embedding import EmbeddingInterface
 from custom_exceptions import AccessException, OpenAIException
+from log_configs import log
 
 
 # pylint: disable=too-few-public-methods, super-init-not-called,
+BATCH_SIZE = int(os.getenv("OPENAI_EMBEDDING_BATCH_SIZE", "512"))
+BATCH_TOKENS = int(os.getenv("OPENAI_EMBEDDING_BATCH_TOKENS", "100000"))
+MAX_RETRIES = int(os.getenv("OPENAI_EMBEDDING_MAX_RETRIES", "3"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_EMBEDDING_MAX_CONCURRENT_REQUESTS", "4"))
+# Errors after which the same request may well succeed, so it is sent again after a pause
+TRANSIENT_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+)
 
 
 class OpenAIEmbedding(EmbeddingInterface):
@@ -18,13 +34,15 @@ class OpenAIEmbedding(EmbeddingInterface):
     model: str = None
     api_object = None
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-arguments
         self,  # pylint: disable=super-init-not-called
         key: str = os.getenv("OPENAI_API_KEY"),
         api_key: Optional[str] = os.getenv(
             "OPENAI_API_KEY"
         ),  # the set_embedding method uses api_key, so it's accepted here for cross-compatibility
         model: str = "text-embedding-ada-002",
+        batch_size: int = BATCH_SIZE,
+        batch_tokens: int = BATCH_TOKENS,
     ) -> None:
         """Sets the API key and initializes library objects if any"""
         self.api_key = key if key is not None else api_key
@@ -36,13 +54,128 @@ class OpenAIEmbedding(EmbeddingInterface):
         self.api_object = openai
         self.api_object.api_key = key
         self.model = model
+        self.model_name = model
+        self.batch_size = max(1, batch_size)
+        self.batch_tokens = max(1, batch_tokens)
+        try:
+            self.tokenizer = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.tokenizer = tiktoken.get_encoding("cl100k_base")
 
     def get_embeddings(self, doc_list: List[schema.Document]) -> None:
         """Generate embedding for the .text values and sets them to .embedding field of i/p items"""
-        for doc in doc_list:
-            input_text = doc.text.replace("\n", " ")
-            response = openai.Embedding.create(
-                input=input_text, model=self.model)
-            if "data" not in response:
-                raise OpenAIException(str(response))
-            doc.embedding = response["data"][0]["embedding"]
+        input_texts = [doc.text.replace("\n", " ") for doc in doc_list]
+        for batch in self._make_batches(input_texts):
+            vectors = self._embed_batch([input_texts[idx] for idx in batch])
+            for idx, vector in zip(batch, vectors):
+                doc_list[idx].embedding = vector
+
+    async def aget_embeddings(self, doc_list: List[schema.Document]) -> None:
+        """Same as get_embeddings, but with OpenAI's async client and
+        a few batches in flight at a time"""
+        input_texts = [doc.text.replace("\n", " ") for doc in doc_list]
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def embed_batch(batch):
+            async with semaphore:
+                vectors = await self._aembed_batch([input_texts[idx] for idx in batch])
+            for idx, vector in zip(batch, vectors):
+                doc_list[idx].embedding = vector
+
+        await asyncio.gather(
+            *[embed_batch(batch) for batch in self._make_batches(input_texts)]
+        )
+
+    def _make_batches(self, input_texts: List[str]) -> List[List[int]]:
+        """Packs the indices of the texts into batches that stay within
+        the item and token budgets of a single request"""
+        batches = []
+        current, current_tokens = [], 0
+        for idx, text in enumerate(input_texts):
+            num_tokens = len(self.tokenizer.encode(text))
+            if current and (
+                len(current) >= self.batch_size
+                or current_tokens + num_tokens > self.batch_tokens
+            ):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(idx)
+            current_tokens += num_tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_batch(self, input_texts: List[str]) -> List[List[float]]:
+        """Embeds one batch with a single request. Transient errors, like rate limits,
+        are retried for the whole batch with exponential backoff. If OpenAI rejects
+        the input, the batch is split and the halves are tried separately,
+        so one bad input doesn't fail the others"""
+        for attempt in range(MAX_RETRIES):
+            try:
+                response = openai.Embedding.create(input=input_texts, model=self.model)
+                return self._vectors(response)
+            except openai.error.InvalidRequestError as exe:
+                if len(input_texts) == 1:
+                    raise OpenAIException(str(exe)) from exe
+                self._log_split(input_texts, exe)
+                middle = len(input_texts) // 2
+                return self._embed_batch(input_texts[:middle]) + self._embed_batch(
+                    input_texts[middle:]
+                )
+            except TRANSIENT_ERRORS as exe:
+                if attempt + 1 == MAX_RETRIES:
+                    raise OpenAIException(str(exe)) from exe
+                self._log_retry(attempt, exe)
+                time.sleep(2**attempt)
+            except openai.error.OpenAIError as exe:
+                raise OpenAIException(str(exe)) from exe
+        raise OpenAIException("No attempts made, OPENAI_EMBEDDING_MAX_RETRIES is 0")
+
+    async def _aembed_batch(self, input_texts: List[str]) -> List[List[float]]:
+        """Async version of _embed_batch, with the same retry and split behaviour"""
+        for attempt in range(MAX_RETRIES):
+            try:
+                response = await openai.Embedding.acreate(
+                    input=input_texts, model=self.model
+                )
+                return self._vectors(response)
+            except openai.error.InvalidRequestError as exe:
+                if len(input_texts) == 1:
+                    raise OpenAIException(str(exe)) from exe
+                self._log_split(input_texts, exe)
+                middle = len(input_texts) // 2
+                first_half = await self._aembed_batch(input_texts[:middle])
+                second_half = await self._aembed_batch(input_texts[middle:])
+                return first_half + second_half
+            except TRANSIENT_ERRORS as exe:
+                if attempt + 1 == MAX_RETRIES:
+                    raise OpenAIException(str(exe)) from exe
+                self._log_retry(attempt, exe)
+                await asyncio.sleep(2**attempt)
+            except openai.error.OpenAIError as exe:
+                raise OpenAIException(str(exe)) from exe
+        raise OpenAIException("No attempts made, OPENAI_EMBEDDING_MAX_RETRIES is 0")
+
+    @staticmethod
+    def _vectors(response) -> List[List[float]]:
+        """The embeddings from a response, in the order of the inputs"""
+        if "data" not in response:
+            raise OpenAIException(str(response))
+        items = sorted(response["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in items]
+
+    @staticmethod
+    def _log_split(input_texts: List[str], exe: Exception) -> None:
+        """Notes that a rejected batch is being split"""
+        log.warning(
+            "OpenAI rejected an embedding request for %s inputs, retrying as two halves: %s",
+            len(input_texts),
+            exe,
+        )
+
+    @staticmethod
+    def _log_retry(attempt: int, exe: Exception) -> None:
+        """Notes that a request is being sent again"""
+        log.warning(
+            "OpenAI embedding request failed, retrying in %s seconds: %s", 2**attempt, exe
+        )
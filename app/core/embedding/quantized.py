@@ -0,0 +1,32 @@
+"""Implemetations for embedding interface, with int8 quantized models for CPU inference"""
+from core.embedding.sentence_transformers import SentenceTransformerEmbedding, BATCH_SIZE
+
+# pylint: disable=too-few-public-methods, import-outside-toplevel
+
+
+class QuantizedSentenceTransformerEmbedding(SentenceTransformerEmbedding):
+    """Uses sentence_transformers models with their linear layers dynamically
+    quantized to int8. The vectors have the same dimension as the fp32 model's"""
+
+    backend_name: str = "sentence-transformers-int8"
+
+    def __init__(
+        self,
+        model: str = SentenceTransformerEmbedding.default_model,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        """Initializes the quantized model"""
+        super().__init__(model=model, batch_size=batch_size)
+        # Vectors differ slightly from the fp32 model's, so they are kept apart in caches
+        self.model_name = f"{model}:int8"
+
+    @staticmethod
+    def load_model(model: str):
+        """Loads the model on CPU and quantizes it. Called only once per process, by the registry"""
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        fp32_model = SentenceTransformer(model, device="cpu")
+        return torch.quantization.quantize_dynamic(
+            fp32_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
@@ -0,0 +1,72 @@
+"""Process wide registry of loaded embedding models"""
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from log_configs import log
+
+MAX_MODELS = int(os.getenv("EMBEDDING_MODEL_REGISTRY_SIZE", "2"))
+
+
+class ModelRegistry:
+    """Loads each model once per process and hands out the same instance.
+    At most max_models are pinned in memory. Beyond that, the least recently used
+    ones are unpinned, and get freed once no embedding object is using them."""
+
+    def __init__(self, max_models: int = MAX_MODELS) -> None:
+        """Sets the cap on pinned models"""
+        self.max_models = max(1, max_models)
+        self.pinned = OrderedDict()
+        self.live = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def get(self, key: Hashable, loader: Callable):
+        """Returns the model for the key, calling loader() only if it isn't loaded yet"""
+        with self.lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        # Loading takes seconds, so only callers waiting for the same model are blocked
+        with load_lock:
+            with self.lock:
+                model = self._lookup(key)
+                if model is not None:
+                    return model
+            log.info("Loading embedding model %s into the registry", key)
+            model = loader()
+            with self.lock:
+                self.live[key] = model
+                self._pin(key, model)
+                self.load_locks.pop(key, None)
+            return model
+
+    def _lookup(self, key: Hashable):
+        """Finds a pinned model, or one that was unpinned but is still in use"""
+        if key in self.pinned:
+            self.pinned.move_to_end(key)
+            return self.pinned[key]
+        model = self.live.get(key)
+        if model is not None:
+            self._pin(key, model)
+        return model
+
+    def _pin(self, key: Hashable, model) -> None:
+        """Keeps a strong reference to the model,
+        unpinning the least recently used ones beyond the cap"""
+        self.pinned[key] = model
+        self.pinned.move_to_end(key)
+        while len(self.pinned) > self.max_models:
+            evicted_key, _ = self.pinned.popitem(last=False)
+            log.info("Unpinned embedding model %s from the registry", evicted_key)
+
+    def loaded_models(self) -> list:
+        """Keys of the models currently in memory"""
+        with self.lock:
+            return list(self.live.keys())
+
+
+model_registry = ModelRegistry()
@@ -1,9 +1,13 @@
 """Implemetations for embedding interface"""
+import os
 from typing import List
 from log_configs import log
 
 import schema
 from core.embedding import EmbeddingInterface
+from core.embedding.registry import model_registry
+
+BATCH_SIZE = int(os.getenv("SENTENCE_TRANSFORMER_BATCH_SIZE", "32"))
 
 
 # pylint: disable=super-init-not-called,too-few-public-methods,,import-outside-toplevel
@@ -11,25 +15,45 @@ class SentenceTransformerEmbedding(EmbeddingInterface):
     """Uses sentence_transformers to generate embeddings."""
 
     default_model: str = "thenlper/gte-small"
+    backend_name: str = "sentence-transformers"
 
-    def __init__(self, model: str = default_model) -> None:
+    def __init__(self, model: str = default_model, batch_size: int = BATCH_SIZE) -> None:
         """Initializes the model"""
 
-        # If SentenceTransformerEmbedding is being instantiated for the first
-        # time, it will download the model from the internet. Delay will depend
-        # on model size. Downloaded model will be stored in root/.cache by default
+        # If the model is being loaded for the first time, it will download the
+        # model from the internet. Delay will depend on model size. Downloaded model
+        # will be stored in root/.cache by default. The loaded model is shared
+        # by all instances in the process, via the registry.
         log.info(
             f"Initializing SentenceTransformerEmbedding with model: {model}.")
 
+        self.model = model_registry.get(
+            (self.backend_name, model), lambda: self.load_model(model)
+        )
+        self.model_name = model
+        self.batch_size = max(1, batch_size)
+
+    @staticmethod
+    def load_model(model: str):
+        """Loads the model. Called only once per process, by the registry"""
         from sentence_transformers import SentenceTransformer
 
-        self.model = SentenceTransformer(model)
+        return SentenceTransformer(model)
 
     def get_embeddings(self, doc_list: List[schema.Document]) -> None:
         """
         Generates embeddings for the .text values and sets them to .embedding field of i/p items
         """
-        for doc in doc_list:
-            doc_text_stripped = doc.text.strip()
-            encoded_doc_text = self.model.encode([doc_text_stripped])
-            doc.embedding = encoded_doc_text[0]
+        texts = [doc.text.strip() for doc in doc_list]
+        # Encode texts of similar length together so that each batch needs little padding,
+        # then scatter the vectors back to the positions of the original documents
+        order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+        for start in range(0, len(order), self.batch_size):
+            batch_ids = order[start : start + self.batch_size]
+            encoded_texts = self.model.encode(
+                [texts[idx] for idx in batch_ids],
+                batch_size=self.batch_size,
+                show_progress_bar=False,
+            )
+            for idx, vector in zip(batch_ids, encoded_texts):
+                doc_list[idx].embedding = vector
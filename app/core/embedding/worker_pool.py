@@ -0,0 +1,136 @@
+"""Process pool that spreads local embedding generation over all cores"""
+import os
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import List
+
+import numpy as np
+
+import schema
+from core.embedding import EmbeddingInterface
+from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from log_configs import log
+
+# pylint: disable=too-few-public-methods, super-init-not-called
+WORKERS = int(os.getenv("EMBEDDING_WORKERS", "0"))
+WORKER_BATCH_SIZE = int(os.getenv("EMBEDDING_WORKER_BATCH_SIZE", "256"))
+
+_WORKER_EMBEDDING = None
+
+
+def _init_worker(model: str) -> None:
+    """Runs once in each worker process, to load its own copy of the model"""
+    global _WORKER_EMBEDDING  # pylint: disable=global-statement
+    _WORKER_EMBEDDING = SentenceTransformerEmbedding(model=model)
+
+
+def _embed_in_worker(texts: List[str], block_name: str) -> None:
+    """Embeds the texts and writes the vectors into the parent's shared memory block,
+    so that only the block's name travels between the processes"""
+    docs = [schema.Document(docId=str(num), text=text) for num, text in enumerate(texts)]
+    _WORKER_EMBEDDING.get_embeddings(doc_list=docs)
+    matrix = np.asarray([doc.embedding for doc in docs], dtype=np.float32)
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        np.ndarray(matrix.shape, dtype=np.float32, buffer=block.buf)[:] = matrix
+    finally:
+        block.close()
+
+
+def _dimension_in_worker() -> int:
+    """The vector size of the worker's model"""
+    return _WORKER_EMBEDDING.model.get_sentence_embedding_dimension()
+
+
+_POOLS = {}  # (model, workers) -> pool
+_DIMENSIONS = {}  # (model, workers) -> vector size
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(model: str, workers: int = WORKERS) -> ProcessPoolExecutor:
+    """One pool per model and worker count, created on first use
+    and kept for the life of the process"""
+    with _POOLS_LOCK:
+        if (model, workers) not in _POOLS:
+            log.info("Starting %s embedding worker processes for %s", workers, model)
+            _POOLS[(model, workers)] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model,),
+            )
+        return _POOLS[(model, workers)]
+
+
+def get_dimension(model: str, workers: int = WORKERS) -> int:
+    """Vector size of the model, asked of a worker once per pool,
+    so that the parent needn't load the model"""
+    key = (model, workers)
+    if key not in _DIMENSIONS:
+        _DIMENSIONS[key] = get_pool(model, workers).submit(_dimension_in_worker).result()
+    return _DIMENSIONS[key]
+
+
+def shutdown_pools() -> None:
+    """Stops all worker processes"""
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        _POOLS.clear()
+        _DIMENSIONS.clear()
+
+
+class ProcessPoolEmbedding(EmbeddingInterface):
+    """Generates sentence_transformers embeddings on a pool of worker processes"""
+
+    def __init__(
+        self,
+        model: str = SentenceTransformerEmbedding.default_model,
+        workers: int = WORKERS,
+        batch_size: int = WORKER_BATCH_SIZE,
+    ) -> None:
+        """Sets the model and how the work is split"""
+        self.model_name = model
+        self.workers = workers if workers > 0 else os.cpu_count()
+        self.batch_size = max(1, batch_size)
+
+    def get_embeddings(self, doc_list: List[schema.Document]) -> None:
+        """
+        Generates embeddings for the .text values and sets them to .embedding field of i/p items
+        """
+        pool = get_pool(self.model_name, self.workers)
+        dimension = get_dimension(self.model_name, self.workers)
+        texts = [doc.text for doc in doc_list]
+        # Sorting by length keeps the padding low inside every batch
+        order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+        batches = [
+            order[start : start + self.batch_size]
+            for start in range(0, len(order), self.batch_size)
+        ]
+        # The blocks are made and removed here, so none is left behind if a worker fails
+        blocks = [
+            shared_memory.SharedMemory(create=True, size=len(batch) * dimension * 4)
+            for batch in batches
+        ]
+        futures = []
+        try:
+            for batch, block in zip(batches, blocks):
+                futures.append(
+                    pool.submit(_embed_in_worker, [texts[idx] for idx in batch], block.name)
+                )
+            for batch, block, future in zip(batches, blocks, futures):
+                future.result()
+                matrix = np.ndarray(
+                    (len(batch), dimension), dtype=np.float32, buffer=block.buf
+                )
+                for idx, vector in zip(batch, matrix):
+                    doc_list[idx].embedding = vector.copy()
+                del matrix
+        finally:
+            # Every worker is done with its block before any is removed, even after a failure
+            wait(futures)
+            for block in blocks:
+                block.close()
+                block.unlink()
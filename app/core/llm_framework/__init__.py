@@ -1,5 +1,7 @@
 """Interface definition and common implemetations for lmm framework classes"""
 import os
+import asyncio
+from functools import partial
 from typing import List, Tuple
 from abc import abstractmethod, ABC
 import schema
@@ -29,3 +31,12 @@ class LLMFrameworkInterface(ABC):
     ) -> dict:
         """Prompt completion for QA or Chat reponse, based on specific documents, if provided"""
         return {}
+
+    async def agenerate_text(
+        self, query: str, chat_history: List[Tuple[str, str]], **kwargs
+    ) -> dict:
+        """Awaitable generate_text. Unless overridden, runs it in a thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, partial(self.generate_text, query, chat_history, **kwargs)
+        )
@@ -69,7 +69,7 @@ class LangchainOpenAI(LLMFrameworkInterface):
         """Prompt completion for QA or Chat reponse, based on specific documents, if provided"""
         if len(kwargs) > 0:
             log.warning(
-                "Unused arguments in LangchainOpenAI.generate_text(): ", **kwargs
+                "Unused arguments in LangchainOpenAI.generate_text(): %s", kwargs
             )
         try:
             return self.chain({"question": query, "chat_history": chat_history})
@@ -78,3 +78,21 @@ class LangchainOpenAI(LLMFrameworkInterface):
         except Exception as exe:
             raise OpenAIException(
                 "While generating answer: " + str(exe)) from exe
+
+    async def agenerate_text(
+        self, query: str, chat_history: List[Tuple[str, str]], **kwargs
+    ) -> dict:
+        """Awaitable generate_text, with the retrieval and LLM calls done asynchronously"""
+        if len(kwargs) > 0:
+            log.warning(
+                "Unused arguments in LangchainOpenAI.agenerate_text(): %s", kwargs
+            )
+        try:
+            return await self.chain.acall(
+                {"question": query, "chat_history": chat_history}
+            )
+        except ChatErrorResponse as exe:
+            raise exe
+        except Exception as exe:
+            raise OpenAIException(
+                "While generating answer: " + str(exe)) from exe
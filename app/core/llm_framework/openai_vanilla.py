@@ -14,6 +14,14 @@ from log_configs import log
 # pylint: disable=fixme
 
 
+def get_query_text(query, chat_history):
+    """Vectordb results are currently returned based on the whole chat history.
+    We'll need to figure out if this is optimal or not."""
+    query_text = "\n".join([x[0] + "/n" + x[1][:50] + "\n" for x in chat_history])
+    query_text += "\n" + query
+    return query_text
+
+
 def get_context(source_documents):
     """Constructs a context string based on the provided results."""
     context = "["
@@ -101,16 +109,16 @@ class OpenAIVanilla(LLMFrameworkInterface):  # pylint: disable=too-few-public-me
         """Prompt completion for QA or Chat reponse, based on specific documents,
         if provided"""
         if len(kwargs) > 0:
-            log.warning("Unused arguments in VanillaOpenAI.generate_text(): ", **kwargs)
+            log.warning("Unused arguments in VanillaOpenAI.generate_text(): %s", kwargs)
 
-        # Vectordb results are currently returned based on the whole chat history.
-        # We'll need to figure out if this is optimal or not.
-        query_text = "\n".join([x[0] + "/n" + x[1][:50] + "\n" for x in chat_history])
-        query_text += "\n" + query
-        source_documents = self.vectordb.get_relevant_documents(query_text)
+        source_documents = self.vectordb.get_relevant_documents(
+            get_query_text(query, chat_history)
+        )
         context = get_context(source_documents)
         pre_prompt = get_pre_prompt(context, response_language=response_language)
-        prompt = append_query_to_prompt(pre_prompt, query, chat_history, response_language=response_language)
+        prompt = append_query_to_prompt(
+            pre_prompt, query, chat_history, response_language=response_language
+        )
         print(f"{prompt=}")
 
         try:
@@ -127,3 +135,38 @@ class OpenAIVanilla(LLMFrameworkInterface):  # pylint: disable=too-few-public-me
 
         except Exception as exe:
             raise OpenAIException("While generating answer: " + str(exe)) from exe
+
+    async def agenerate_text(
+        self,
+        query: str,
+        chat_history: List[Tuple[str, str]],
+        response_language: str = "English",
+        **kwargs,
+    ) -> dict:
+        """Awaitable generate_text, with the retrieval and completion done asynchronously"""
+        if len(kwargs) > 0:
+            log.warning("Unused arguments in VanillaOpenAI.agenerate_text(): %s", kwargs)
+
+        source_documents = await self.vectordb.aget_relevant_documents(
+            get_query_text(query, chat_history)
+        )
+        context = get_context(source_documents)
+        pre_prompt = get_pre_prompt(context, response_language=response_language)
+        prompt = append_query_to_prompt(
+            pre_prompt, query, chat_history, response_language=response_language
+        )
+
+        try:
+            response = await openai.ChatCompletion.acreate(
+                model=self.model_name,
+                temperature=0,
+                messages=[{"role": "user", "content": prompt}],
+            )
+            return {
+                "question": query,
+                "answer": response["choices"][0]["message"]["content"],
+                "source_documents": source_documents,
+            }
+
+        except Exception as exe:
+            raise OpenAIException("While generating answer: " + str(exe)) from exe
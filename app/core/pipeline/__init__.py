@@ -14,6 +14,9 @@ from core.file_processor.langchain_loader import LangchainLoader
 from core.file_processor.vanilla_loader import VanillaLoader
 from core.embedding.openai import OpenAIEmbedding
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.embedding.quantized import QuantizedSentenceTransformerEmbedding
+from core.embedding.cache import CachedEmbedding, CACHE_ENABLED
+from core.embedding.worker_pool import ProcessPoolEmbedding, WORKERS
 from core.vectordb.chroma import Chroma
 from core.vectordb.chroma4langchain import Chroma as ChromaLC
 from core.vectordb.postgres4langchain import Postgres
@@ -24,17 +27,58 @@ from core.audio.whisper import WhisperAudioTranscription
 # pylint: disable=unused-argument, dangerous-default-value, too-many-arguments
 
 
+def _openai_embedding(api_key: Optional[str], **args) -> EmbeddingInterface:
+    """OpenAI embeddings, with the user's key if one is given"""
+    if not api_key is None:
+        args["key"] = api_key
+    return OpenAIEmbedding(**args)
+
+
+def _local_embedding(api_key: Optional[str], **args) -> EmbeddingInterface:
+    """sentence_transformers, on worker processes if EMBEDDING_WORKERS is set"""
+    if WORKERS > 0:
+        return ProcessPoolEmbedding(**args)
+    return SentenceTransformerEmbedding(**args)
+
+
+def _quantized_embedding(api_key: Optional[str], **args) -> EmbeddingInterface:
+    """sentence_transformers with an int8 model"""
+    return QuantizedSentenceTransformerEmbedding(**args)
+
+
+# Builder and default model of each embedding choice. A model given by the user is used instead
+EMBEDDING_CHOICES = {
+    schema.EmbeddingType.OPENAI: (_openai_embedding, None),
+    schema.EmbeddingType.HUGGINGFACE_DEFAULT: (_local_embedding, None),
+    schema.EmbeddingType.HUGGINGFACE_MULTILINGUAL: (
+        _local_embedding,
+        "sentence-transformers/LaBSE",
+    ),
+    schema.EmbeddingType.HUGGINGFACE_DEFAULT_QUANTIZED: (_quantized_embedding, None),
+    schema.EmbeddingType.HUGGINGFACE_MULTILINGUAL_QUANTIZED: (
+        _quantized_embedding,
+        "sentence-transformers/LaBSE",
+    ),
+}
+
+
 class DataUploadPipeline:
     """Interface for implementing dataupload tech stack"""
 
+    # Whether set_embedding puts the disk cache in front of the embedding.
+    # Only document texts are cached, not the questions of a conversation
+    cache_embeddings = True
+
     def __init__(
         self,
         file_processor: FileProcessorInterface = LangchainLoader,
-        embedding: EmbeddingInterface = SentenceTransformerEmbedding(),
+        embedding: Optional[EmbeddingInterface] = None,
         vectordb: VectordbInterface = Chroma(),
     ) -> None:
         """Define the stack with defaults, in the constructor"""
         self.file_processor = file_processor()
+        if embedding is None:
+            embedding = SentenceTransformerEmbedding()
         self.embedding = embedding
         self.vectordb = vectordb
 
@@ -56,33 +100,18 @@ class DataUploadPipeline:
         **kwargs
     ) -> None:
         """Change the default tech with one of our choice"""
-        if choice == schema.EmbeddingType.OPENAI:
-            args = {}
-            if not api_key is None:
-                args["key"] = api_key
-            if not model is None:
-                args["model"] = model
-            self.embedding = OpenAIEmbedding(**args)
-
-        elif choice == schema.EmbeddingType.HUGGINGFACE_DEFAULT:
-            args = {}
-            if not model is None:
-                args["model"] = model
-            self.embedding = SentenceTransformerEmbedding(**args)
-
-        elif choice == schema.EmbeddingType.HUGGINGFACE_MULTILINGUAL:
-            args = {}
-            if not model is None:
-                args[
-                    "model"
-                ] = model  # ? Do we need to allow model override if we are using multilingual?
-            else:
-                args["model"] = "sentence-transformers/LaBSE"
-            self.embedding = SentenceTransformerEmbedding(**args)
-
-        else:
+        if choice not in EMBEDDING_CHOICES:
             raise GenericException(
                 "This technology type is not supported (yet)!")
+        make_embedding, default_model = EMBEDDING_CHOICES[choice]
+        args = {}
+        if not model is None:
+            args["model"] = model
+        elif not default_model is None:
+            args["model"] = default_model
+        self.embedding = make_embedding(api_key, **args)
+        if CACHE_ENABLED and self.cache_embeddings:
+            self.embedding = CachedEmbedding(self.embedding)
 
     def set_vectordb(
         self,
@@ -90,7 +119,6 @@ class DataUploadPipeline:
         host_n_port: schema.HostnPortPattern = None,
         path: Optional[str] = None,
         collection_name: Optional[str] = None,
-        embedding_function=SentenceTransformerEmbedding(),
         **kwargs
     ) -> None:
         """Change the default tech with one of our choice"""
@@ -104,12 +132,16 @@ class DataUploadPipeline:
         if not collection_name is None:
             args["collection_name"] = collection_name
         if choice == schema.DatabaseType.CHROMA:
+            args["embedding"] = kwargs.get("embedding")
             self.vectordb = Chroma(**args)
         elif choice == schema.DatabaseType.POSTGRES:
             args["user"] = kwargs.get("user")
             args["password"] = kwargs.get("password")
             args["embedding"] = kwargs.get("embedding")
             args["labels"] = kwargs.get("labels")
+            args["search_effort"] = kwargs.get("search_effort")
+            args["search_mode"] = kwargs.get("search_mode")
+            args["metadata_filter"] = kwargs.get("metadata_filter")
             self.vectordb = Postgres(**args)
         else:
             raise GenericException(
@@ -119,12 +151,14 @@ class DataUploadPipeline:
 class ConversationPipeline(DataUploadPipeline):
     """The tech stack for implementing chat bot"""
 
+    cache_embeddings = False
+
     def __init__(
         self,  # pylint: disable=too-many-arguments,dangerous-default-value
         user,
         labels: List[str] = ["ESV-Bible"],
         file_processor: FileProcessorInterface = LangchainLoader,
-        embedding: EmbeddingInterface = SentenceTransformerEmbedding(),
+        embedding: Optional[EmbeddingInterface] = None,
         vectordb: VectordbInterface = Chroma(),
         llm_framework: LLMFrameworkInterface = LangchainOpenAI(),
         transcription_framework: AudioTranscriptionInterface = WhisperAudioTranscription,
@@ -135,7 +169,6 @@ class ConversationPipeline(DataUploadPipeline):
         if labels is not None:
             self.labels = labels
         self.chat_history = []
-        self.embedding = embedding
         self.vectordb = vectordb
         self.llm_framework = llm_framework
         self.transcription_framework = transcription_framework()
@@ -158,6 +191,7 @@ class ConversationPipeline(DataUploadPipeline):
                     port=vectordb.db_port,
                     path=vectordb.db_path,
                     collection_name=vectordb.collection_name,
+                    embedding=getattr(vectordb, "embedding", None),
                 )
             self.llm_framework = LangchainOpenAI(vectordb=vectordb)
         elif choice == schema.LLMFrameworkType.VANILLA:
@@ -167,6 +201,7 @@ class ConversationPipeline(DataUploadPipeline):
                     port=vectordb.db_port,
                     path=vectordb.db_path,
                     collection_name=vectordb.collection_name,
+                    embedding=getattr(vectordb, "embedding", None),
                 )
             self.llm_framework = OpenAIVanilla(vectordb=vectordb)
 
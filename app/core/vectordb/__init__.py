@@ -32,11 +32,24 @@ class VectordbInterface(ABC):
     def get_relevant_documents(self, query: str, **kwargs) -> List:
         """Similarity search on the vector store"""
 
+    def get_relevant_documents_batch(
+        self, queries: List[str], labels: List[str] = None, k: int = None
+    ) -> List[List]:
+        """Similarity search for many queries, returning the documents for each query
+        in the same order. Implementations should embed and search in one batch;
+        this default only searches one query at a time"""
+        return [self.get_relevant_documents(query) for query in queries]
+
     @abstractmethod
     def get_available_labels(self) -> List[str]:
         """Query DB and find out the list of labels available in metadata,
         to be used for later filtering"""
 
+    @abstractmethod
+    def get_label_catalog(self) -> List[dict]:
+        """The labels available, each with its label, doc_count and updated_at,
+        from a catalog the DB keeps up to date on adding documents"""
+
     def get(self, **kwargs) -> List:
         """Return properties of the DB"""
         return self.db_conn.get(**kwargs)
@@ -1,20 +1,135 @@
 """Implemetations for vectordb interface for chroma"""
 import os
-from typing import List
+from collections import Counter
+from datetime import datetime, timezone
+from typing import List, Optional
 
 from core.vectordb import VectordbInterface
+from core.embedding import EmbeddingInterface
+from core.vectordb.chroma_clients import (
+    get_client,
+    get_collection,
+    get_write_lock,
+    mark_dirty,
+)
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.embedding.batcher import get_batcher
 import schema
 from custom_exceptions import ChromaException
 
-import chromadb
-from chromadb.config import Settings
-
-# pylint: disable=too-few-public-methods, unused-argument, R0801, super-init-not-called
+# pylint: disable=too-few-public-methods, unused-argument, too-many-arguments, R0801, super-init-not-called
 QUERY_LIMIT = os.getenv("CHROMA_DB_QUERY_LIMIT", "10")
 
 
-class Chroma(VectordbInterface):
+def label_filter(labels: List[str]) -> Optional[dict]:
+    """Chroma where clause matching any of the labels. $or needs two or more items"""
+    if not labels:
+        return None
+    if len(labels) == 1:
+        return {"label": labels[0]}
+    return {"$or": [{"label": label} for label in labels]}
+
+
+def _no_embedding(texts: List[str]) -> List[List[float]]:
+    """The catalog's entries aren't searched, so they get a placeholder vector"""
+    return [[0.0] for _ in texts]
+
+
+def get_label_catalog_collection(host, port, path, collection):
+    """The collection that keeps the label catalog of collection, one entry per label.
+    Filled in from the documents if it is empty while the collection isn't"""
+    catalog = get_collection(host, port, path, collection.name + "_labels")
+    with get_write_lock(host, port, path):
+        if catalog.count() == 0 and collection.count() > 0:
+            rows = collection.get(include=["metadatas"])
+            update_label_catalog(
+                catalog, [], [meta.get("label") for meta in rows["metadatas"]]
+            )
+    return catalog
+
+
+def update_label_catalog(catalog, old_labels: List[str], new_labels: List[str]) -> None:
+    """Applies the change in counts of replacing documents with old_labels by ones
+    with new_labels. Labels left without documents are removed"""
+    counts = Counter(label for label in new_labels if label is not None)
+    counts.subtract(label for label in old_labels if label is not None)
+    if not counts:
+        return
+    current = catalog.get(ids=list(counts), include=["metadatas"])
+    doc_counts = {meta["label"]: meta["doc_count"] for meta in current["metadatas"]}
+    updated_at = datetime.now(timezone.utc).isoformat()
+    entries = [
+        {
+            "label": label,
+            "doc_count": doc_counts.get(label, 0) + change,
+            "updated_at": updated_at,
+        }
+        for label, change in counts.items()
+    ]
+    kept = [entry for entry in entries if entry["doc_count"] > 0]
+    emptied = [entry["label"] for entry in entries if entry["doc_count"] <= 0]
+    if kept:
+        catalog.upsert(
+            ids=[entry["label"] for entry in kept],
+            embeddings=_no_embedding(kept),
+            metadatas=kept,
+        )
+    if emptied:
+        catalog.delete(ids=emptied)
+
+
+def upsert_documents(
+    collection,
+    catalog,
+    write_lock,
+    docs: List[schema.Document],
+    embedding: EmbeddingInterface,
+) -> None:
+    """Adds the documents to the collection, replacing those with the same ids,
+    and updates the label catalog by the labels replaced and added. Of repeated ids
+    the last document is kept. The write lock is held from reading the old labels
+    till the catalog is updated, so concurrent uploads don't miscount.
+    Documents without an embedding are embedded first, outside the lock"""
+    unique_docs = list({doc.docId: doc for doc in docs}.values())
+    ids = [doc.docId for doc in unique_docs]
+    metas = []
+    for doc in unique_docs:
+        meta = {}
+        meta.update(doc.metadata)
+        meta.update(
+            {
+                "label": doc.label,
+                "media": ",".join(doc.media),
+                "links": ",".join(doc.links),
+            }
+        )
+        metas.append(meta)
+    missing = [doc for doc in unique_docs if doc.embedding is None]
+    if missing:
+        embedding.get_embeddings(missing)
+    embeddings = [[float(val) for val in doc.embedding] for doc in unique_docs]
+    with write_lock:
+        old = collection.get(ids=ids, include=["metadatas"])
+        collection.upsert(
+            embeddings=embeddings,
+            documents=[doc.text for doc in unique_docs],
+            metadatas=metas,
+            ids=ids,
+        )
+        update_label_catalog(
+            catalog,
+            [meta.get("label") for meta in old["metadatas"]],
+            [doc.label for doc in unique_docs],
+        )
+
+
+def read_label_catalog(catalog) -> List[dict]:
+    """All entries of the catalog, sorted by label"""
+    rows = catalog.get(include=["metadatas"])
+    return sorted(rows["metadatas"], key=lambda meta: meta["label"])
+
+
+class Chroma(VectordbInterface):  # pylint: disable=too-many-instance-attributes
     """Interface for vector database technology, its connection, configs and operations"""
 
     db_host: str = None  # Host name to connect to a remote DB deployment
@@ -25,12 +140,20 @@ class Chroma(VectordbInterface):
     )
     db_conn = None
     db_client = None
+    label_catalog = None
+    embedding = None
     embedding_function = None
 
     def __init__(
-        self, host=None, port=None, path="chromadb_store", collection_name=None
+        self,
+        host=None,
+        port=None,
+        path="chromadb_store",
+        collection_name=None,
+        embedding: Optional[EmbeddingInterface] = None,
     ) -> None:  # pylint: disable=super-init-not-called
-        """Instanciate a chroma client"""
+        """Instanciate a chroma client. embedding should be the one the collection
+        was built with. The default model is used if it isn't given"""
         if host:
             self.db_host = host
         if port:
@@ -38,100 +161,87 @@ class Chroma(VectordbInterface):
         self.db_path = path
         if collection_name:
             self.collection_name = collection_name
-        if self.db_host is None and self.db_port is None:
-            # This method connects to the DB that get stored on the server itself
-            # where the app is running
-            try:
-                chroma_client = chromadb.Client(
-                    Settings(chroma_db_impl="duckdb+parquet",
-                             persist_directory=path)
-                )
-            except Exception as exe:
-                raise ChromaException(
-                    "While initializing client: " + str(exe)) from exe
-        else:
-            # This method requires us to run the chroma DB as a separate service
-            # (say in docker-compose).
-            # In future this would allow us to keep multiple options for DB connection,
-            # letting different users set up and host their own chroma DBs where ever they please
-            # and just use the correct host and port.
-            # Also need to sort out the following
-            # * Let the connection details, host, port and collection name be passed in requests
-            # * how authentication for chorma DB access will work in that case
-            # * how the connection can be handled like session that is started upon
-            #   each user's API request to let each user connect to the DB
-            #   that he prefers and has rights for(fastapi's Depends())
-            try:
-                chroma_client = chromadb.Client(
-                    Settings(
-                        chroma_api_impl="rest",
-                        chroma_server_host=host,
-                        chroma_server_http_port=port,
-                    )
-                )
-            except Exception as exe:
-                raise ChromaException(
-                    "While initializing client: " + str(exe)) from exe
         try:
-            # Check for passed embedding function, or use schema.EmbeddingType.DEFAULT
-            if not self.embedding_function:
-                embedding_function = SentenceTransformerEmbedding().get_embeddings
-            self.db_conn = chroma_client.get_or_create_collection(
-                name=self.collection_name,
-                embedding_function=embedding_function,
+            # Shared across instances, so that a local DB is loaded from disk only once
+            self.db_client = get_client(self.db_host, self.db_port, path)
+        except Exception as exe:
+            raise ChromaException(
+                "While initializing client: " + str(exe)) from exe
+        try:
+            # The model itself is shared by all instances, via the model registry
+            if embedding is None:
+                embedding = SentenceTransformerEmbedding()
+            self.embedding = embedding
+            self.embedding_function = embedding.embed_queries
+            self.db_conn = get_collection(
+                self.db_host,
+                self.db_port,
+                path,
+                self.collection_name,
+            )
+            self.label_catalog = get_label_catalog_collection(
+                self.db_host, self.db_port, path, self.db_conn
             )
-            self.db_client = chroma_client
         except Exception as exe:
             raise ChromaException(
                 "While initializing collection: " + str(exe)) from exe
 
     def add_to_collection(self, docs: List[schema.Document], **kwargs) -> None:
         """Loads the document object as per chroma DB formats into the collection"""
-        metas = []
-        for doc in docs:
-            meta = {}
-            meta.update(doc.metadata)
-            meta.update(
-                {
-                    "label": doc.label,
-                    "media": ",".join(doc.media),
-                    "links": ",".join(doc.links),
-                }
-            )
-            metas.append(meta)
-        if docs[0].embedding is None:
-            embeddings = None
-        else:
-            embeddings = [doc.embedding for doc in docs]
         try:
-            self.db_conn.add(
-                embeddings=embeddings,
-                documents=[doc.text for doc in docs],
-                metadatas=metas,
-                ids=[doc.docId for doc in docs],
+            upsert_documents(
+                self.db_conn,
+                self.label_catalog,
+                get_write_lock(self.db_host, self.db_port, self.db_path),
+                docs,
+                self.embedding,
             )
-            self.db_client.persist()
         except Exception as exe:
             raise ChromaException("While adding data: " + str(exe)) from exe
+        # Written to disk in the background, see chroma_clients
+        mark_dirty(self.db_host, self.db_port, self.db_path, len(docs))
 
     def get_relevant_documents(self, query: str, **kwargs) -> List:
         """Similarity search on the vector store"""
+        # Embedded here, since the collection would do it with the DB's lock held
+        query_vector = get_batcher(self.embedding).embed(query)
         results = self.db_conn.query(
-            query_texts=[query],
-            n_results=QUERY_LIMIT,
+            query_embeddings=[[float(val) for val in query_vector]],
+            n_results=int(QUERY_LIMIT),
             # where={"metadata_field": "is_equal_to_this"},
             # where_document={"$contains":"search_string"}
         )
         return results
 
+    def get_relevant_documents_batch(
+        self, queries: List[str], labels: List[str] = None, k: int = None
+    ) -> List[dict]:
+        """Similarity search for many queries, embedded as one batch and sent as one query.
+        Returns the ids, documents, metadatas and distances found for each query"""
+        vectors = self.embedding.embed_queries(queries)
+        try:
+            results = self.db_conn.query(
+                query_embeddings=[[float(val) for val in vector] for vector in vectors],
+                n_results=int(QUERY_LIMIT if k is None else k),
+                where=label_filter(labels),
+            )
+        except Exception as exe:
+            raise ChromaException("While querying: " + str(exe)) from exe
+        fields = ["ids", "documents", "metadatas", "distances"]
+        return [
+            {field: results[field][num] for field in fields}
+            for num in range(len(queries))
+        ]
+
     def get_available_labels(self) -> List[str]:
         """Query DB and find out the list of labels available in metadata,
         to be used for later filtering"""
-        rows = self.db_conn.get(include=["metadatas"])
-        labels = [meta["label"] for meta in rows["metadatas"]]
-        labels = list(set(labels))
-        return labels
-
-    def __del__(self):
-        """To persist DB upon app close"""
-        self.db_client.persist()
+        return [entry["label"] for entry in self.get_label_catalog()]
+
+    def get_label_catalog(self) -> List[dict]:
+        """The labels with their document counts and last update times,
+        as kept in the collection's label catalog"""
+        try:
+            return read_label_catalog(self.label_catalog)
+        except Exception as exe:
+            raise ChromaException("While querying for labels: " + str(exe)) from exe
@@ -0,0 +1,257 @@
+"""Process wide chroma clients and collections, shared by the Chroma instances,
+and the write-behind persistence of the local ones"""
+import os
+import time
+import functools
+import threading
+
+import chromadb
+from chromadb.config import Settings
+
+from custom_exceptions import ChromaException
+from log_configs import log
+
+# A local DB is written to disk this many seconds after its first unsaved change,
+# or as soon as this many rows are unsaved, and on shutdown
+PERSIST_INTERVAL = float(os.getenv("CHROMA_DB_PERSIST_INTERVAL", "30"))
+PERSIST_DIRTY_ROWS = int(os.getenv("CHROMA_DB_PERSIST_DIRTY_ROWS", "5000"))
+# Writes to disk after every add instead, so that nothing is lost if the process crashes
+PERSIST_SYNC = os.getenv("CHROMA_DB_PERSIST_SYNC", "false").lower() == "true"
+
+
+class SerializedHandle:  # pylint: disable=too-few-public-methods
+    """Proxy to a chroma client or collection that holds a lock during each method call.
+    The local duckdb+parquet mode runs every query on one duckdb connection,
+    which concurrent requests can't use at the same time. Texts should be embedded
+    before the call, so that the model doesn't run while the lock is held"""
+
+    def __init__(self, target, lock) -> None:
+        """Wraps target, with the lock of its client"""
+        self._target = target
+        self._lock = lock
+
+    def __getattr__(self, name):
+        """The target's attributes, with its methods run under the lock"""
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def locked(*args, **kwargs):
+            with self._lock:
+                return value(*args, **kwargs)
+
+        return locked
+
+
+class ClientEntry:  # pylint: disable=too-few-public-methods
+    """A shared client, with the lock and persistence state of a local one"""
+
+    def __init__(self, client, local: bool) -> None:
+        """Local clients get a lock, remote ones are used as they are"""
+        self.client = client
+        self.lock = threading.RLock() if local else None
+        # Held across read-modify-write sequences, like label catalog updates
+        self.write_lock = self.lock or threading.RLock()
+        self.dirty_rows = 0
+        self.dirty_since = None
+        self.stats = {
+            "flushes": 0,
+            "last_flush_seconds": None,
+            "total_flush_seconds": 0.0,
+            "last_flushed_at": None,
+        }
+
+    def flush(self) -> None:
+        """Writes the DB to disk if there are unsaved changes"""
+        with self.lock:
+            if self.dirty_rows == 0:
+                return
+            rows = self.dirty_rows
+            start = time.perf_counter()
+            self.client.persist()
+            seconds = time.perf_counter() - start
+            self.dirty_rows = 0
+            self.dirty_since = None
+            self.stats["flushes"] += 1
+            self.stats["last_flush_seconds"] = seconds
+            self.stats["total_flush_seconds"] += seconds
+            self.stats["last_flushed_at"] = time.time()
+        log.info("Persisted chroma DB, %s changed rows, in %.3f seconds", rows, seconds)
+
+    def is_due(self, now: float) -> bool:
+        """Whether the unsaved changes should be written now"""
+        return self.dirty_rows > 0 and (
+            self.dirty_rows >= PERSIST_DIRTY_ROWS
+            or now - self.dirty_since >= PERSIST_INTERVAL
+        )
+
+
+_clients = {}  # client key -> ClientEntry
+_collections = {}  # (client key, collection name) -> collection handle
+_registry_lock = threading.Lock()
+_FLUSHER = None
+_flusher_wake = threading.Event()
+_flusher_stop = threading.Event()
+
+
+def _client_key(host, port, path) -> tuple:
+    """The mode and location of a chroma DB"""
+    if host is None and port is None:
+        return ("local", os.path.abspath(path))
+    return ("rest", f"{host}:{port}")
+
+
+def _wrap(target, lock):
+    """Serializes the target's calls if its client needs that"""
+    return target if lock is None else SerializedHandle(target, lock)
+
+
+def _get_entry(host, port, path) -> ClientEntry:
+    """The client for a location, created the first time.
+    Called with the registry lock held"""
+    key = _client_key(host, port, path)
+    if key not in _clients:
+        if key[0] == "local":
+            # This method connects to the DB that get stored on the server itself
+            # where the app is running
+            client = chromadb.Client(
+                Settings(chroma_db_impl="duckdb+parquet", persist_directory=path)
+            )
+            _clients[key] = ClientEntry(client, local=True)
+            _start_flusher()
+        else:
+            # This method requires us to run the chroma DB as a separate service
+            # (say in docker-compose).
+            client = chromadb.Client(
+                Settings(
+                    chroma_api_impl="rest",
+                    chroma_server_host=host,
+                    chroma_server_http_port=port,
+                )
+            )
+            _clients[key] = ClientEntry(client, local=False)
+    return _clients[key]
+
+
+def get_client(host=None, port=None, path="chromadb_store"):
+    """The shared client for a local path, or for a chroma server if host or port is given"""
+    with _registry_lock:
+        entry = _get_entry(host, port, path)
+    return _wrap(entry.client, entry.lock)
+
+
+def _embedded_by_caller(texts):
+    """The embedding function of the shared collections. Callers bring vectors
+    of their own model, so chroma is never left to embed texts by itself"""
+    raise ChromaException(
+        f"{len(texts)} texts given to a shared collection without their embeddings"
+    )
+
+
+def get_collection(host, port, path, collection_name: str):
+    """The shared handle of a collection, created if it doesn't exist yet.
+    All callers share it, whatever their embedding, since they pass vectors
+    to every add and query"""
+    with _registry_lock:
+        entry = _get_entry(host, port, path)
+        key = (_client_key(host, port, path), collection_name)
+        handle = _collections.get(key)
+        if handle is None:
+            collection = _wrap(entry.client, entry.lock).get_or_create_collection(
+                name=collection_name, embedding_function=_embedded_by_caller
+            )
+            handle = _wrap(collection, entry.lock)
+            _collections[key] = handle
+        return handle
+
+
+def get_write_lock(host=None, port=None, path="chromadb_store"):
+    """The lock to hold across a sequence of reads and writes to a DB, so that
+    other threads' writes don't come in between. For a local DB this is the lock
+    its calls are serialized with"""
+    with _registry_lock:
+        return _get_entry(host, port, path).write_lock
+
+
+def mark_dirty(host, port, path, rows: int) -> None:
+    """Records rows written to a local DB, to be persisted by the flusher.
+    With CHROMA_DB_PERSIST_SYNC they are persisted right away.
+    A remote chroma server persists by itself, so there this does nothing"""
+    with _registry_lock:
+        entry = _clients.get(_client_key(host, port, path))
+    if entry is None or entry.lock is None:
+        return
+    with entry.lock:
+        if entry.dirty_rows == 0:
+            entry.dirty_since = time.monotonic()
+        entry.dirty_rows += rows
+        due_now = entry.dirty_rows >= PERSIST_DIRTY_ROWS
+    if PERSIST_SYNC:
+        entry.flush()
+    elif due_now:
+        _flusher_wake.set()
+
+
+def _flush_due() -> None:
+    """Persists the local clients whose changes are due. Run by the flusher thread"""
+    now = time.monotonic()
+    with _registry_lock:
+        entries = [entry for entry in _clients.values() if entry.lock is not None]
+    for entry in entries:
+        if entry.is_due(now):
+            try:
+                entry.flush()
+            except Exception as exe:  # pylint: disable=broad-except
+                # Still dirty, so it is tried again on the next round
+                log.exception("While persisting chroma DB: %s", exe)
+
+
+def _flusher_loop() -> None:
+    """Checks for due changes every second, or right away when woken up"""
+    while not _flusher_stop.is_set():
+        _flusher_wake.wait(timeout=min(1.0, max(0.1, PERSIST_INTERVAL)))
+        _flusher_wake.clear()
+        _flush_due()
+
+
+def _start_flusher() -> None:
+    """Starts the background flusher, if it isn't running. Called with the registry lock held"""
+    global _FLUSHER  # pylint: disable=global-statement
+    if _FLUSHER is None or not _FLUSHER.is_alive():
+        _flusher_stop.clear()
+        _FLUSHER = threading.Thread(
+            target=_flusher_loop, name="chroma-persist", daemon=True
+        )
+        _FLUSHER.start()
+
+
+def get_persist_stats() -> list:
+    """Unsaved rows and flush timings of each local DB"""
+    with _registry_lock:
+        items = [(key, entry) for key, entry in _clients.items() if entry.lock is not None]
+    return [
+        {"path": key[1], "dirty_rows": entry.dirty_rows, **entry.stats}
+        for key, entry in items
+    ]
+
+
+def close_all_clients() -> None:
+    """Persists the unsaved changes of the local clients, stops the flusher
+    and forgets all clients, like on app shutdown or before deleting a local DB folder"""
+    global _FLUSHER  # pylint: disable=global-statement
+    _flusher_stop.set()
+    _flusher_wake.set()
+    if _FLUSHER is not None:
+        _FLUSHER.join()
+        _FLUSHER = None
+    with _registry_lock:
+        for key, entry in _clients.items():
+            if entry.lock is None:
+                continue
+            try:
+                entry.flush()
+            except Exception as exe:  # pylint: disable=broad-except
+                log.exception("While persisting chroma DB at %s: %s", key[1], exe)
+        _clients.clear()
+        _collections.clear()
@@ -1,23 +1,255 @@
 """Implemetations for vectordb interface for postgres with vector store"""
-import math
 import os
-from typing import List, Optional
+import json
+import hashlib
+import functools
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
 from langchain.schema import Document as LangchainDocument
 from langchain.schema import BaseRetriever
 from core.vectordb import VectordbInterface
-from core.embedding import EmbeddingInterface
+from core.vectordb.postgres_copy import array_literal, copy_upsert
+from core.vectordb.postgres_ddl import TEXT_SEARCH_CONFIG, bootstrap_database
+from core.vectordb.postgres_index import (
+    LABEL_INDEXES,
+    RERANK_FACTORS,
+    STORAGE_MODE,
+    ann_order,
+    ensure_label_indexes,
+    get_index_status,
+    indexed_storage_mode,
+    known_storage_mode,
+    rebuild_index,
+    schedule_index_update,
+    search_settings,
+)
+from core.vectordb.postgres_labels import (
+    existing_labels,
+    get_label_catalog,
+    lock_label_catalog,
+    update_label_catalog,
+)
+from core.vectordb.postgres_pool import get_pool, get_async_pool
+from core.embedding import EmbeddingInterface, get_embedding_dimension
+from core.embedding.batcher import get_batcher
+from core.vectordb.retrieval_cache import (
+    normalize_query,
+    query_embedding_cache,
+    retrieval_cache,
+)
 import schema
-from custom_exceptions import PostgresException, GenericException
+from custom_exceptions import (
+    PostgresException,
+    GenericException,
+    UnprocessableException,
+)
 import numpy as np
 
-import psycopg2
+from psycopg2 import sql
 from psycopg2.extras import execute_values
 from pgvector.psycopg2 import register_vector
+from pgvector.utils import to_db
 from log_configs import log
 
 # pylint: disable=too-few-public-methods, unused-argument, too-many-arguments, R0801
 QUERY_LIMIT = os.getenv("POSTGRES_DB_QUERY_LIMIT", "10")
 MAX_COSINE_DISTANCE = os.getenv("POSTGRES_MAX_COSINE_DISTANCE", "0.1")
+UPSERT_PAGE_SIZE = int(os.getenv("POSTGRES_DB_UPSERT_PAGE_SIZE", "500"))
+COPY_THRESHOLD = int(os.getenv("POSTGRES_DB_COPY_THRESHOLD", "5000"))
+SEARCH_EFFORT = os.getenv("POSTGRES_DB_SEARCH_EFFORT", "balanced")
+SEARCH_MODE = os.getenv("POSTGRES_DB_SEARCH_MODE", "vector")
+# The k of reciprocal rank fusion: a document's score is the sum of 1 / (k + rank)
+# over the rankings it is in. A larger k flattens the difference between top ranks
+RRF_K = int(os.getenv("POSTGRES_DB_RRF_K", "60"))
+# Server-side prepared statements kept per pooled connection
+PREPARED_STATEMENTS_MAX = int(os.getenv("POSTGRES_DB_PREPARED_STATEMENTS_MAX", "64"))
+# The vector index applies a metadata filter only to the rows it has found. If at most
+# this many rows pass the filter, they are all ranked exactly, without the index.
+# Otherwise this many times more candidates are fetched from the index
+FILTER_EXACT_ROWS = int(os.getenv("POSTGRES_DB_FILTER_EXACT_ROWS", "10000"))
+FILTER_CANDIDATE_FACTOR = int(os.getenv("POSTGRES_DB_FILTER_CANDIDATE_FACTOR", "10"))
+
+# set_config instead of SET LOCAL, since that can't take bind parameters.
+# With is_local it also only lasts till the end of the transaction
+SET_LOCAL_QUERY = "SELECT set_config(%s, %s, true)"
+ASYNC_SET_LOCAL_QUERY = "SELECT set_config($1, $2, true)"
+SEARCH_ARG_TYPES = ["text[]", "vector", "float8", "int", "int"]
+BATCH_SEARCH_ARG_TYPES = ["text[]", "vector[]", "float8", "int", "int"]
+PER_LABEL_SEARCH_ARG_TYPES = ["vector", "float8", "int", "int"]
+HYBRID_SEARCH_ARG_TYPES = SEARCH_ARG_TYPES + ["text", "int", "text"]
+
+
+# In the queries below, the nearest candidates are found in the order of the index,
+# and re-ranked by their exact distance. With full vectors the two orders are the same,
+# and the candidates are just the results. The distance is computed once per row,
+# and the cut-off applied to the nearest rows, which gives the same rows
+# as filtering first, as long as the index order is kept
+
+
+def metadata_filter_clause(metadata_filter: dict, first_param: int) -> Tuple[str, list]:
+    """The SQL conditions for a metadata filter, and their jsonb parameters numbered
+    from first_param. The filter maps keys to a value, or to {"$in": [values]} for any
+    of those. Each is a containment test on the metadata, which the GIN index serves"""
+    equal = {}
+    any_of = []
+    for key, value in (metadata_filter or {}).items():
+        if isinstance(value, dict):
+            if list(value) != ["$in"] or not isinstance(value["$in"], list):
+                raise UnprocessableException(
+                    f"Unsupported metadata filter for {key}: {value}. "
+                    + 'Use a value or {"$in": [values]}'
+                )
+            any_of.append([json.dumps({key: item}) for item in value["$in"]])
+        else:
+            equal[key] = value
+    conditions = []
+    args = []
+    if equal:
+        args.append(json.dumps(equal, sort_keys=True))
+        conditions.append(f"metadata @> ${first_param}")
+    for options in any_of:
+        if not options:
+            # An empty $in matches nothing
+            conditions.append("false")
+            continue
+        params = range(first_param + len(args), first_param + len(args) + len(options))
+        args.extend(options)
+        conditions.append(
+            "(" + " OR ".join(f"metadata @> ${param}" for param in params) + ")"
+        )
+    return "".join(" AND " + condition for condition in conditions), args
+
+
+def filter_matches_query(filter_sql: str) -> str:
+    """Counts the rows of the labels, $1, that pass a metadata filter, stopping at $2.
+    Takes the filter parameters as $3 onwards"""
+    return f"""
+    SELECT count(*) FROM (
+        SELECT 1 FROM embeddings WHERE label = ANY($1){filter_sql} LIMIT $2
+    ) AS matches
+    """
+
+
+def search_effort_setting(value) -> schema.SearchEffort:
+    """The search effort named by value, such as POSTGRES_DB_SEARCH_EFFORT"""
+    try:
+        return schema.SearchEffort(value)
+    except ValueError as exe:
+        raise GenericException(
+            f"Unsupported search effort: {value}. Use one of: "
+            + ", ".join(effort.value for effort in schema.SearchEffort)
+        ) from exe
+
+
+def search_query(storage_mode: str, dimension: int, filter_sql: str = "") -> str:
+    """The similarity query. Takes the labels, query vector, distance cut-off,
+    limit and number of candidates as $1 to $5, and any metadata filter
+    parameters after those"""
+    return f"""
+    SELECT source_id, document, distance
+    FROM (
+        SELECT source_id, document, embedding <=> $2 AS distance
+        FROM embeddings
+        WHERE label = ANY($1){filter_sql}
+        ORDER BY {ann_order(storage_mode, dimension, "$2")}
+        LIMIT $5
+    ) AS candidates
+    WHERE distance < $3
+    ORDER BY distance
+    LIMIT $4
+    """
+
+
+def batch_search_query(storage_mode: str, dimension: int, filter_sql: str = "") -> str:
+    """One round-trip for many query vectors, with the nearest rows of each one looked up
+    by a lateral join, and ordinality to tell them apart. Takes the labels,
+    query vectors, distance cut-off, limit and number of candidates as $1 to $5,
+    and any metadata filter parameters after those"""
+    return f"""
+    SELECT queries.num, nearest.source_id, nearest.document, nearest.distance
+    FROM unnest($2::vector[]) WITH ORDINALITY AS queries (vector, num)
+    CROSS JOIN LATERAL (
+        SELECT source_id, document, distance
+        FROM (
+            SELECT source_id, document, embedding <=> queries.vector AS distance
+            FROM embeddings
+            WHERE label = ANY($1){filter_sql}
+            ORDER BY {ann_order(storage_mode, dimension, "queries.vector")}
+            LIMIT $5
+        ) AS candidates
+        ORDER BY distance
+        LIMIT $4
+    ) AS nearest
+    WHERE nearest.distance < $3
+    ORDER BY queries.num, nearest.distance
+    """
+
+
+def hybrid_search_query(storage_mode: str, dimension: int, filter_sql: str = "") -> str:
+    """The vector search and a full-text search over document_tsv, fused by reciprocal rank.
+    Takes the labels, query vector, distance cut-off, limit and number of candidates
+    as $1 to $5, the query text as $6, the RRF k as $7, the text search config as $8,
+    and any metadata filter parameters after those. The cut-off only applies to the vector ranking,
+    so that documents with the exact words are found even if their embeddings aren't close"""
+    return f"""
+    WITH semantic AS (
+        SELECT id, row_number() OVER (ORDER BY distance) AS rank
+        FROM (
+            SELECT id, embedding <=> $2 AS distance
+            FROM embeddings
+            WHERE label = ANY($1){filter_sql}
+            ORDER BY {ann_order(storage_mode, dimension, "$2")}
+            LIMIT $5
+        ) AS candidates
+        WHERE distance < $3
+        ORDER BY distance
+        LIMIT $4
+    ),
+    lexical AS (
+        SELECT id, row_number() OVER (ORDER BY text_rank DESC) AS rank
+        FROM (
+            SELECT id, ts_rank_cd(document_tsv, tsquery) AS text_rank
+            FROM embeddings,
+                websearch_to_tsquery($8::regconfig, $6)
+                    AS tsquery
+            WHERE document_tsv @@ tsquery AND label = ANY($1){filter_sql}
+            ORDER BY text_rank DESC
+            LIMIT $4
+        ) AS matches
+    ),
+    fused AS (
+        SELECT
+            COALESCE(semantic.id, lexical.id) AS id,
+            COALESCE(1.0 / ($7 + semantic.rank), 0)
+                + COALESCE(1.0 / ($7 + lexical.rank), 0) AS score
+        FROM semantic FULL OUTER JOIN lexical ON semantic.id = lexical.id
+    )
+    SELECT embeddings.source_id, embeddings.document, embeddings.embedding <=> $2 AS distance
+    FROM fused JOIN embeddings ON embeddings.id = fused.id
+    ORDER BY fused.score DESC, distance
+    LIMIT $4
+    """
+
+
+def per_label_search_query(
+    num_labels: int, storage_mode: str, dimension: int, filter_sql: str = ""
+) -> str:
+    """The similarity query as a UNION ALL of one search per label, so that each can
+    use its label's partial index. That needs a custom plan, made with the labels' values,
+    see _search_settings. Takes the vector, distance cut-off, limit and number of
+    candidates as $1 to $4, the labels as $5 onwards, and any metadata filter
+    parameters after those"""
+    branches = [
+        "(SELECT source_id, document, embedding <=> $1 AS distance "
+        + f"FROM embeddings WHERE label = ${5 + num}{filter_sql} "
+        + f"ORDER BY {ann_order(storage_mode, dimension, '$1')} LIMIT $4)"
+        for num in range(num_labels)
+    ]
+    return (
+        "SELECT source_id, document, distance FROM ("
+        + " UNION ALL ".join(branches)
+        + ") AS candidates WHERE distance < $2 ORDER BY distance LIMIT $3"
+    )
 
 
 class Postgres(
@@ -34,6 +266,7 @@ class Postgres(
     db_password = os.environ.get("POSTGRES_DB_PASSWORD", "secret")
     embedding: EmbeddingInterface = None
     db_client = None
+    pool = None
 
     def __init__(
         self,
@@ -56,11 +289,19 @@ class Postgres(
                 "size always hard-coded on init"
             )
         self.embedding = embedding
-        self.labels = kwargs.get("labels", ["tyndale_open"])
+        labels = kwargs.get("labels", ["tyndale_open"])
+        self.labels = [] if labels is None else list(labels)
         self.query_limit = kwargs.get("query_limit", QUERY_LIMIT)
         self.max_cosine_distance = kwargs.get(
             "max_cosine_distance", MAX_COSINE_DISTANCE
         )
+        self.search_effort = search_effort_setting(
+            kwargs.get("search_effort") or SEARCH_EFFORT
+        )
+        self.search_mode = schema.SearchMode(kwargs.get("search_mode") or SEARCH_MODE)
+        self.metadata_filter = kwargs.get("metadata_filter") or {}
+        self.label_indexes = kwargs.get("label_indexes", LABEL_INDEXES)
+        self.storage_mode = kwargs.get("storage_mode", STORAGE_MODE)
         if host:
             self.db_host = host
         if port:
@@ -74,219 +315,504 @@ class Postgres(
         self.db_path = path
         if collection_name:
             self.collection_name = collection_name
+        self.collection_key = (self.db_host, str(self.db_port), self.collection_name)
         try:
-            self.db_conn = psycopg2.connect(
-                user=self.db_user,
-                password=self.db_password,
+            self.pool = get_pool(
                 host=self.db_host,
                 port=self.db_port,
                 dbname=self.collection_name,
+                user=self.db_user,
+                password=self.db_password,
             )
-            cur = self.db_conn.cursor()
-
-            # install pgvector
-            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
-            self.db_conn.commit()
-
-            # Register the vector type with psycopg2
-            register_vector(self.db_conn)
-
-            if self.embedding:
-                test_doc = schema.Document(docId="test", text="test")
-                self.embedding.get_embeddings([test_doc])
-                embedding_vector_size = len(test_doc.embedding)
-                log.info(
-                    "Using PGVector embedding dimension size: %s", embedding_vector_size
-                )
-            else:
-                embedding_vector_size = (
-                    schema.EmbeddingDimensionSize.HUGGINGFACE_DEFAULT
-                )
-                log.info(
-                    "Using PGVector embedding dimension size: %s", embedding_vector_size
-                )
-
-            # Create table to store embeddings and metadata
-            table_create_command = f"""
-            CREATE TABLE IF NOT EXISTS embeddings (
-                        id bigserial primary key,
-                        source_id text unique,
-                        document text,
-                        label text,
-                        media text,
-                        links text,
-                        embedding vector({embedding_vector_size}),
-                        metadata jsonb
-                        );
-                        """
-
-            cur.execute(table_create_command)
-            cur.close()
-            self.db_conn.commit()
+            self.dimension = get_embedding_dimension(self.embedding)
+            with self.pool.connection() as db_conn:
+                bootstrap_database(db_conn, self.collection_key, self.dimension)
+                # Looked up once per database, for _order_mode
+                known_storage_mode(db_conn, self.collection_key)
         except Exception as exe:
             raise PostgresException(
                 "While initializing client: " + str(exe)) from exe
 
+    @contextmanager
+    def _connection(self):
+        """Borrows a connection from the pool, with the vector type registered on it"""
+        with self.pool.connection() as db_conn:
+            if not db_conn.vector_registered:
+                register_vector(db_conn)
+                db_conn.vector_registered = True
+            yield db_conn
+
     def add_to_collection(self, docs: List[schema.Document], **kwargs) -> None:
         """Loads the document object as per chroma DB formats into the collection"""
-        data_list = []
-        for doc in docs:
-            cur = self.db_conn.cursor()
-            cur.execute(
-                "SELECT 1 FROM embeddings WHERE source_id = %s", (doc.docId,))
-            doc_id_already_exists = cur.fetchone()
-            if not doc_id_already_exists:
-                data_list.append(
-                    [
-                        doc.docId,
-                        doc.text,
-                        doc.label,
-                        doc.media,
-                        doc.links,
-                        doc.embedding,
-                    ]
-                )
-            else:
-                # Update instead of add
-                cur.execute(
-                    """
-                    UPDATE embeddings 
-                    SET 
-                        document = %s, 
-                        label = %s, 
-                        media = %s, 
-                        links = %s, 
-                        embedding = %s 
-                    WHERE 
-                        source_id = %s
-                    """,
-                    (
-                        doc.text,
-                        doc.label,
-                        doc.media,
-                        doc.links,
-                        doc.embedding,
-                        doc.docId,
-                    ),
-                )
-            cur.close()
+        page_size = kwargs.get("page_size", UPSERT_PAGE_SIZE)
+        # A statement can't upsert the same row twice, so only the last of repeated ids is kept
+        unique_docs = {doc.docId: doc for doc in docs}.values()
+        data_list = [
+            [
+                doc.docId,
+                doc.text,
+                doc.label,
+                array_literal(doc.media),
+                array_literal(doc.links),
+                json.dumps(doc.metadata),
+                doc.embedding,
+            ]
+            for doc in unique_docs
+        ]
         try:
-            cur = self.db_conn.cursor()
-            execute_values(
-                cur,
-                "INSERT INTO embeddings (source_id, document, label, media, links, embedding"
-                ") VALUES %s",
-                data_list,
-            )
-            self.db_conn.commit()
-
-            # create index
-            cur.execute("SELECT COUNT(*) as cnt FROM embeddings;")
-            num_records = cur.fetchone()[0]
-            num_lists = num_records / 1000
-            num_lists = max(10, num_lists, math.sqrt(num_records))
-            # use the cosine distance measure, which is what we'll later use for querying
-            cur.execute(
-                "CREATE INDEX ON embeddings USING ivfflat (embedding vector_cosine_ops) "
-                + f"WITH (lists = {num_lists});"
-            )
-            self.db_conn.commit()
-
-            cur.close()
+            with self._connection() as db_conn:
+                cur = db_conn.cursor()
+                lock_label_catalog(cur)
+                old_labels = existing_labels(cur, [row[0] for row in data_list])
+                if kwargs.get("use_copy", len(data_list) >= COPY_THRESHOLD):
+                    copy_upsert(cur, data_list)
+                else:
+                    self._upsert_rows(cur, data_list, page_size)
+                update_label_catalog(cur, old_labels, [row[2] for row in data_list])
+                db_conn.commit()
+                cur.close()
         except Exception as exe:
             raise PostgresException("While adding data: " + str(exe)) from exe
+        finally:
+            retrieval_cache.invalidate(self.collection_key)
+        # Built off the request, see postgres_index
+        schedule_index_update(
+            self.collection_key, [doc.label for doc in docs], self._update_indexes
+        )
 
-    def get_relevant_documents(self, query: list, **kwargs) -> List[LangchainDocument]:
-        """Similarity search on the vector store"""
-        query_doc = schema.Document(docId="xxx", text=query)
+    def _update_indexes(self, labels: set) -> None:
+        """Rebuilds the vector index if it is due, and adds the missing
+        per-label indexes for labels, if those are in use"""
+        with self._connection() as db_conn:
+            rebuild_index(
+                db_conn, storage_mode=self.storage_mode, db_key=self.collection_key
+            )
+            if self.label_indexes:
+                ensure_label_indexes(db_conn, labels, self.storage_mode)
+
+    def _order_mode(self) -> str:
+        """The storage mode whose expression searches order by. Without an index
+        built for the configured mode, they order by the exact distance, since a
+        quantized expression without its index would be scanned and then truncated"""
+        if indexed_storage_mode(self.collection_key) == self.storage_mode:
+            return self.storage_mode
+        return "full"
+
+    @staticmethod
+    def _upsert_rows(cur, data_list: List[list], page_size: int) -> None:
+        """Writes the rows with INSERT ... ON CONFLICT, one statement per page"""
+        execute_values(
+            cur,
+            """
+            INSERT INTO embeddings
+                (source_id, document, label, media, links, metadata, embedding)
+            VALUES %s
+            ON CONFLICT (source_id) DO UPDATE
+            SET
+                document = EXCLUDED.document,
+                label = EXCLUDED.label,
+                media = EXCLUDED.media,
+                links = EXCLUDED.links,
+                metadata = EXCLUDED.metadata,
+                embedding = EXCLUDED.embedding
+            """,
+            data_list,
+            template="(%s, %s, %s, %s, %s, %s::jsonb, %s)",
+            page_size=page_size,
+        )
+
+    def get_index_status(self) -> dict:
+        """Details of the vector index and whether it is due for a rebuild"""
         try:
-            self.embedding.get_embeddings(doc_list=[query_doc])
-            query_vector = query_doc.embedding
+            with self._connection() as db_conn:
+                return get_index_status(db_conn, storage_mode=self.storage_mode)
         except Exception as exe:
-            raise GenericException(
-                "While vectorising the query: " + str(exe)) from exe
+            raise PostgresException(
+                "While checking the vector index: " + str(exe)) from exe
+
+    def rebuild_index(self, force: bool = True) -> dict:
+        """Rebuilds the vector index, by default even if it isn't due.
+        Also creates any missing per-label indexes, if those are in use"""
+        labels = self.get_available_labels() if self.label_indexes else []
         try:
-            cur = self.db_conn.cursor()
-            cur.execute(
-                """
-                SELECT source_id, document 
-                FROM embeddings 
-                WHERE label = ANY(%s) 
-                AND embedding <=> %s < %s 
-                ORDER BY embedding <=> %s 
-                LIMIT %s
-                """,
-                (
-                    self.labels,
-                    np.array(query_vector),
-                    self.max_cosine_distance,
-                    np.array(query_vector),
-                    self.query_limit,
-                ),
-            )
-            records = cur.fetchall()
-            cur.close()
+            with self._connection() as db_conn:
+                ensure_label_indexes(db_conn, labels, self.storage_mode)
+                return rebuild_index(
+                    db_conn,
+                    force=force,
+                    storage_mode=self.storage_mode,
+                    db_key=self.collection_key,
+                )
         except Exception as exe:
-            log.exception(exe)
             raise PostgresException(
-                "While querying with embedding: " + str(exe)
-            ) from exe
-        if len(records) == 0:
-            return [
-                LangchainDocument(
-                    page_content=(
-                        "No relevant context documents found. "
-                        "This question can't be answered, but the user could try "
-                        "rewording or asking something else."
-                    ),
-                    metadata={
-                        "source": "no records found"
-                    },
-                )
-            ]
-        return [
-            LangchainDocument(page_content=doc[1], metadata={"source": doc[0]})
-            for doc in records
-        ]
+                "While building the vector index: " + str(exe)) from exe
+
+    def get_relevant_documents(self, query: list, **kwargs) -> List[LangchainDocument]:
+        """Similarity search on the vector store. search_effort, search_mode
+        and metadata_filter can be passed to override the ones set on init"""
+        search_effort = search_effort_setting(
+            kwargs.get("search_effort") or self.search_effort
+        )
+        search_mode = schema.SearchMode(kwargs.get("search_mode") or self.search_mode)
+        metadata_filter = kwargs.get("metadata_filter", self.metadata_filter)
+        cache_key = self._retrieval_cache_key(
+            query, search_effort, search_mode, metadata_filter
+        )
+        cached = retrieval_cache.get(cache_key)
+        if cached is not None:
+            # The rows are cached, so that every caller gets documents of its own
+            return self._to_langchain_documents(cached)
+        embedding_key = (self.embedding.model_name, normalize_query(query))
+        query_vector = query_embedding_cache.get(embedding_key)
+        if query_vector is None:
+            try:
+                query_vector = get_batcher(self.embedding).embed(query)
+            except Exception as exe:
+                raise GenericException(
+                    "While vectorising the query: " + str(exe)) from exe
+            query_embedding_cache.put(embedding_key, query_vector)
+        records = self._search(
+            functools.partial(
+                self._search_statement, query_vector, metadata_filter, query, search_mode
+            ),
+            search_effort,
+            self._filter_check(self.labels, metadata_filter),
+        )
+        retrieval_cache.put(cache_key, tuple(records))
+        return self._to_langchain_documents(records)
 
     async def aget_relevant_documents(
         self, query: list, **kwargs
     ) -> List[LangchainDocument]:
-        """Similarity search on the vector store"""
-        query_doc = schema.Document(docId="xxx", text=query)
+        """Similarity search on the vector store. search_effort, search_mode
+        and metadata_filter can be passed to override the ones set on init"""
+        search_effort = search_effort_setting(
+            kwargs.get("search_effort") or self.search_effort
+        )
+        search_mode = schema.SearchMode(kwargs.get("search_mode") or self.search_mode)
+        metadata_filter = kwargs.get("metadata_filter", self.metadata_filter)
+        cache_key = self._retrieval_cache_key(
+            query, search_effort, search_mode, metadata_filter
+        )
+        cached = retrieval_cache.get(cache_key)
+        if cached is not None:
+            # The rows are cached, so that every caller gets documents of its own
+            return self._to_langchain_documents(cached)
+        embedding_key = (self.embedding.model_name, normalize_query(query))
+        query_vector = query_embedding_cache.get(embedding_key)
+        if query_vector is None:
+            try:
+                query_vector = await get_batcher(self.embedding).aembed(query)
+            except Exception as exe:
+                raise GenericException(
+                    "While vectorising the query: " + str(exe)) from exe
+            query_embedding_cache.put(embedding_key, query_vector)
+        records = await self._asearch(
+            functools.partial(
+                self._search_statement, query_vector, metadata_filter, query, search_mode
+            ),
+            search_effort,
+            self._filter_check(self.labels, metadata_filter),
+        )
+        retrieval_cache.put(cache_key, tuple(records))
+        return self._to_langchain_documents(records)
+
+    def get_relevant_documents_batch(
+        self, queries: List[str], labels: List[str] = None, k: int = None
+    ) -> List[List[LangchainDocument]]:
+        """Similarity search for many queries. The queries not in the query embedding cache
+        are embedded as one batch, and all of them are searched with one statement.
+        labels and k default to those set on init, and the metadata filter set on init
+        applies. This is always a vector search, whatever the search mode"""
+        labels = self.labels if labels is None else labels
+        limit = int(self.query_limit if k is None else k)
+        records = self._search(
+            functools.partial(
+                self._batch_statement, labels, self._query_vectors(queries), limit
+            ),
+            self.search_effort,
+            self._filter_check(labels, self.metadata_filter),
+            limit,
+        )
+        per_query = [[] for _ in queries]
+        for num, source_id, document, distance in records:
+            per_query[num - 1].append((source_id, document, distance))
+        return [self._to_langchain_documents(rows) for rows in per_query]
+
+    def _query_vectors(self, queries: List[str]) -> list:
+        """The embeddings of the queries, from the query embedding cache
+        or else embedded together as one batch"""
+        embedding_keys = [
+            (self.embedding.model_name, normalize_query(query)) for query in queries
+        ]
+        vectors = [query_embedding_cache.get(key) for key in embedding_keys]
+        missing = [num for num, vector in enumerate(vectors) if vector is None]
+        if missing:
+            try:
+                new_vectors = self.embedding.embed_queries(
+                    [queries[num] for num in missing]
+                )
+            except Exception as exe:
+                raise GenericException(
+                    "While vectorising the queries: " + str(exe)) from exe
+            for num, vector in zip(missing, new_vectors):
+                vectors[num] = vector
+                query_embedding_cache.put(embedding_keys[num], vector)
+        return vectors
+
+    def _retrieval_cache_key(
+        self,
+        query: str,
+        search_effort: schema.SearchEffort,
+        search_mode: schema.SearchMode,
+        metadata_filter: dict,
+    ) -> tuple:
+        """Everything the search result depends on. The collection comes first,
+        for invalidation upon writes"""
+        return (
+            self.collection_key,
+            self.embedding.model_name,
+            self.storage_mode,
+            tuple(sorted(self.labels)),
+            str(self.query_limit),
+            str(self.max_cosine_distance),
+            search_effort.value,
+            search_mode.value,
+            json.dumps(metadata_filter, sort_keys=True),
+            normalize_query(query),
+        )
+
+    def _search(
+        self,
+        make_statement,
+        search_effort: schema.SearchEffort,
+        filter_check: Optional[Tuple[str, List[str], tuple]],
+        limit: int = None,
+    ) -> List[tuple]:
+        """Runs the statement that make_statement returns for a number of candidates,
+        see _search_statement. With a metadata filter, the rows that pass it are
+        counted first with the filter_check statement, to decide how to search"""
         try:
-            self.embedding.get_embeddings(doc_list=[query_doc])
-            query_vector = query_doc.embedding
+            with self._connection() as db_conn:
+                cur = db_conn.cursor()
+                matches = None
+                if filter_check is not None:
+                    self._execute_prepared(db_conn, cur, *filter_check)
+                    matches = cur.fetchone()[0]
+                candidates, settings = self._search_plan(search_effort, limit, matches)
+                for name, value in settings.items():
+                    cur.execute(SET_LOCAL_QUERY, (name, value))
+                self._execute_prepared(db_conn, cur, *make_statement(candidates))
+                records = cur.fetchall()
+                cur.close()
+                db_conn.commit()
         except Exception as exe:
-            raise GenericException(
-                "While vectorising the query: " + str(exe)) from exe
+            log.exception(exe)
+            raise PostgresException(
+                "While querying with embedding: " + str(exe)
+            ) from exe
+        return records
+
+    @staticmethod
+    def _execute_prepared(db_conn, cur, query: str, arg_types: List[str], args: tuple):
+        """Runs the query as a server-side prepared statement, which is prepared
+        the first time it is used on each pooled connection. Beyond
+        PREPARED_STATEMENTS_MAX per connection, the least recently used is deallocated"""
+        name = "search_" + hashlib.md5(query.encode("utf-8")).hexdigest()[:16]
+        if name in db_conn.prepared:
+            db_conn.prepared.move_to_end(name)
+        else:
+            while len(db_conn.prepared) >= max(1, PREPARED_STATEMENTS_MAX):
+                evicted, _ = db_conn.prepared.popitem(last=False)
+                cur.execute(sql.SQL("DEALLOCATE {}").format(sql.Identifier(evicted)))
+            # No arguments, so psycopg2 leaves the query text as it is
+            cur.execute(f"PREPARE {name} ({', '.join(arg_types)}) AS {query}")
+            db_conn.prepared[name] = True
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+
+    async def _asearch(
+        self,
+        make_statement,
+        search_effort: schema.SearchEffort,
+        filter_check: Optional[Tuple[str, List[str], tuple]],
+        limit: int = None,
+    ) -> List[tuple]:
+        """Same as _search, on the asyncpg pool, without blocking the event loop"""
         try:
-            cur = self.db_conn.cursor()
-            cur.execute(
-                """
-                SELECT source_id, document 
-                FROM embeddings 
-                WHERE label = ANY(%s) 
-                AND embedding <=> %s < %s 
-                ORDER BY embedding <=> %s 
-                LIMIT %s
-                """,
-                (
-                    self.labels,
-                    np.array(query_vector),
-                    self.max_cosine_distance,
-                    np.array(query_vector),
-                    self.query_limit,
-                ),
+            pool = await get_async_pool(
+                host=self.db_host,
+                port=self.db_port,
+                dbname=self.collection_name,
+                user=self.db_user,
+                password=self.db_password,
             )
-            records = cur.fetchall()
-
-            cur.close()
+            async with pool.acquire() as db_conn, db_conn.transaction():
+                matches = None
+                if filter_check is not None:
+                    matches = await db_conn.fetchval(filter_check[0], *filter_check[2])
+                candidates, settings = self._search_plan(search_effort, limit, matches)
+                for name, value in settings.items():
+                    await db_conn.execute(ASYNC_SET_LOCAL_QUERY, name, value)
+                # asyncpg prepares the statement once per connection and reuses it,
+                # and sends the vector in binary
+                statement = make_statement(candidates)
+                records = await db_conn.fetch(statement[0], *statement[2])
         except Exception as exe:
             log.exception(exe)
             raise PostgresException(
                 "While querying with embedding: " + str(exe)
             ) from exe
+        return [tuple(record) for record in records]
+
+    def _search_statement(
+        self,
+        query_vector,
+        metadata_filter: dict,
+        query: str = None,
+        search_mode: schema.SearchMode = schema.SearchMode.VECTOR,
+        candidates: int = None,
+    ) -> Tuple[str, List[str], tuple]:
+        """The similarity query for the labels, metadata filter and search mode in use,
+        its parameter types and values. candidates is how many rows are fetched
+        in the order of the index, to be re-ranked"""
+        vector = np.asarray(query_vector, dtype=np.float32)
+        limit = int(self.query_limit)
+        candidates = self._candidates(limit) if candidates is None else candidates
+        if search_mode == schema.SearchMode.HYBRID:
+            # Searches across labels with the main index, even if there are per-label ones
+            filter_sql, filter_args = metadata_filter_clause(metadata_filter, 9)
+            return (
+                hybrid_search_query(self._order_mode(), self.dimension, filter_sql),
+                HYBRID_SEARCH_ARG_TYPES + ["jsonb"] * len(filter_args),
+                (
+                    list(self.labels),
+                    vector,
+                    float(self.max_cosine_distance),
+                    limit,
+                    candidates,
+                    str(query),
+                    RRF_K,
+                    TEXT_SEARCH_CONFIG,
+                    *filter_args,
+                ),
+            )
+        if self.label_indexes and self.labels:
+            labels = sorted(set(self.labels))
+            filter_sql, filter_args = metadata_filter_clause(
+                metadata_filter, 5 + len(labels)
+            )
+            return (
+                per_label_search_query(
+                    len(labels), self._order_mode(), self.dimension, filter_sql
+                ),
+                PER_LABEL_SEARCH_ARG_TYPES
+                + ["text"] * len(labels)
+                + ["jsonb"] * len(filter_args),
+                (
+                    vector,
+                    float(self.max_cosine_distance),
+                    limit,
+                    candidates,
+                    *labels,
+                    *filter_args,
+                ),
+            )
+        filter_sql, filter_args = metadata_filter_clause(metadata_filter, 6)
+        return (
+            search_query(self._order_mode(), self.dimension, filter_sql),
+            SEARCH_ARG_TYPES + ["jsonb"] * len(filter_args),
+            (
+                list(self.labels),
+                vector,
+                float(self.max_cosine_distance),
+                limit,
+                candidates,
+                *filter_args,
+            ),
+        )
+
+    def _batch_statement(
+        self, labels: List[str], vectors: list, limit: int, candidates: int
+    ) -> Tuple[str, List[str], tuple]:
+        """The query of get_relevant_documents_batch, its parameter types and values"""
+        filter_sql, filter_args = metadata_filter_clause(self.metadata_filter, 6)
+        return (
+            batch_search_query(self._order_mode(), self.dimension, filter_sql),
+            BATCH_SEARCH_ARG_TYPES + ["jsonb"] * len(filter_args),
+            (
+                list(labels),
+                # As an array literal, since psycopg2 would send a list as text[]
+                "{" + ",".join(f'"{to_db(vector)}"' for vector in vectors) + "}",
+                float(self.max_cosine_distance),
+                limit,
+                candidates,
+                *filter_args,
+            ),
+        )
+
+    @staticmethod
+    def _filter_check(
+        labels: List[str], metadata_filter: dict
+    ) -> Optional[Tuple[str, List[str], tuple]]:
+        """The query that counts the rows passing a metadata filter, up to one more
+        than FILTER_EXACT_ROWS, its parameter types and values. None without a filter"""
+        if not metadata_filter:
+            return None
+        filter_sql, filter_args = metadata_filter_clause(metadata_filter, 3)
+        return (
+            filter_matches_query(filter_sql),
+            ["text[]", "int"] + ["jsonb"] * len(filter_args),
+            (list(labels), FILTER_EXACT_ROWS + 1, *filter_args),
+        )
+
+    def _search_plan(
+        self, search_effort: schema.SearchEffort, limit: int = None, matches: int = None
+    ) -> Tuple[int, dict]:
+        """The number of candidates and the settings for a search. matches is the count
+        from _filter_check, None if there is no metadata filter. The vector index only
+        filters the rows it has found, so a selective filter would leave fewer than
+        the limit. If few rows match, the index is not used and they are all ranked
+        exactly. Otherwise more candidates are fetched, which raises ef_search too"""
+        candidates = self._candidates(limit)
+        extra = {}
+        if matches is not None and matches <= FILTER_EXACT_ROWS:
+            candidates = max(matches, 1)
+            extra["enable_indexscan"] = "off"
+        elif matches is not None:
+            candidates *= FILTER_CANDIDATE_FACTOR
+        settings = self._search_settings(search_effort, candidates)
+        if matches is not None:
+            # The plan depends on the settings above, so a cached generic plan
+            # made for other settings mustn't be reused
+            settings["plan_cache_mode"] = "force_custom_plan"
+        settings.update(extra)
+        return candidates, settings
+
+    def _candidates(self, limit: int = None) -> int:
+        """How many rows the index search fetches to be re-ranked"""
+        limit = int(self.query_limit if limit is None else limit)
+        return limit * RERANK_FACTORS[self._order_mode()]
+
+    def _search_settings(
+        self, search_effort: schema.SearchEffort, limit: int = None
+    ) -> dict:
+        """Index settings for the effort level, as strings for set_config"""
+        settings = {
+            name: str(value)
+            for name, value in search_settings(
+                search_effort.value, int(self.query_limit if limit is None else limit)
+            ).items()
+        }
+        if self.label_indexes:
+            # A generic plan of a prepared statement doesn't know the labels,
+            # so it couldn't pick their partial indexes
+            settings["plan_cache_mode"] = "force_custom_plan"
+        return settings
+
+    @staticmethod
+    def _to_langchain_documents(records: List[tuple]) -> List[LangchainDocument]:
+        """Converts the rows from _search to the format the chains expect,
+        with the cosine distance of each document in its metadata"""
         if len(records) == 0:
             return [
                 LangchainDocument(
@@ -301,20 +827,27 @@ class Postgres(
                 )
             ]
         return [
-            LangchainDocument(page_content=doc[1], metadata={"source": doc[0]})
+            LangchainDocument(
+                page_content=doc[1],
+                metadata={"source": doc[0], "distance": float(doc[2])},
+            )
             for doc in records
         ]
 
     def get_available_labels(self) -> List[str]:
         """Query DB and find out the list of labels available in metadata,
         to be used for later filtering"""
+        return [entry["label"] for entry in self.get_label_catalog()]
+
+    def get_label_catalog(self) -> List[dict]:
+        """The labels with their document counts and last update times,
+        as kept in the label_catalog table"""
         try:
-            cur = self.db_conn.cursor()
-            cur.execute("SELECT distinct(label) from embeddings")
-            records = cur.fetchall()
-            cur.close()
+            with self._connection() as db_conn:
+                cur = db_conn.cursor()
+                catalog = get_label_catalog(cur)
+                cur.close()
         except Exception as exe:
             raise PostgresException(
                 "While querying for labels: " + str(exe)) from exe
-        labels = [row[0] for row in records]
-        return labels
+        return catalog
@@ -0,0 +1,125 @@
+"""Bulk loading into the postgres vector store with binary COPY"""
+import struct
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+COPY_COLUMNS = ["source_id", "document", "label", "media", "links", "metadata", "embedding"]
+# Characters for which postgres quotes an element when it prints an array
+ARRAY_SPECIAL_CHARACTERS = set('{},"\\ \t\n\r\v\f')
+
+
+def _array_element(value) -> str:
+    """One element of an array literal, quoted and escaped the way postgres prints it"""
+    text = str(value)
+    if (
+        text == ""
+        or text.upper() == "NULL"
+        or any(char in ARRAY_SPECIAL_CHARACTERS for char in text)
+    ):
+        return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return text
+
+
+def array_literal(values: Iterable) -> str:
+    """The text postgres stores for a list put into a text column, like {a,b}.
+    Used by both the INSERT and the COPY path, so that they store the same text"""
+    return "{" + ",".join(_array_element(value) for value in values) + "}"
+
+
+def _encode_text(value) -> bytes:
+    """A text field: its length followed by the utf-8 bytes, or -1 for NULL"""
+    if value is None:
+        return struct.pack("!i", -1)
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def _encode_vector(value) -> bytes:
+    """A pgvector field in its binary format: dimension, an unused int16
+    and the big-endian float4 values"""
+    if value is None:
+        return struct.pack("!i", -1)
+    vector = np.asarray(value, dtype=">f4")
+    data = struct.pack("!hh", vector.shape[0], 0) + vector.tobytes()
+    return struct.pack("!i", len(data)) + data
+
+
+def encode_rows(rows: Iterable[list]) -> Iterator[bytes]:
+    """Yields the binary COPY stream for rows in the order of COPY_COLUMNS"""
+    yield COPY_HEADER
+    for row in rows:
+        fields = [_encode_text(value) for value in row[:-1]]
+        fields.append(_encode_vector(row[-1]))
+        yield struct.pack("!h", len(fields)) + b"".join(fields)
+    yield COPY_TRAILER
+
+
+class CopyStream:
+    """File-like reader over encode_rows, so the rows are encoded as psycopg2 sends them
+    instead of being built up in memory first"""
+
+    def __init__(self, rows: Iterable[list]) -> None:
+        """Starts the encoder"""
+        self.chunks = encode_rows(rows)
+        self.buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        """Returns up to size bytes, and b"" once the stream is done"""
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        """copy_expert only uses read, but file-likes are expected to have this"""
+        return self.read(size)
+
+
+def copy_upsert(cur, rows: List[list]) -> None:
+    """Streams rows into a temporary staging table and merges them into embeddings
+    with a single statement. Runs in the caller's transaction, at whose end the
+    staging table is dropped. Of repeated source_ids the last row is kept"""
+    cur.execute(
+        """
+        CREATE TEMP TABLE embeddings_staging (
+            seq bigserial,
+            source_id text,
+            document text,
+            label text,
+            media text,
+            links text,
+            metadata text,
+            embedding vector
+        ) ON COMMIT DROP
+        """
+    )
+    cur.copy_expert(
+        f"COPY embeddings_staging ({', '.join(COPY_COLUMNS)}) FROM STDIN (FORMAT binary)",
+        CopyStream(rows),
+    )
+    cur.execute(
+        """
+        INSERT INTO embeddings
+            (source_id, document, label, media, links, metadata, embedding)
+        SELECT DISTINCT ON (source_id)
+            source_id, document, label, media, links, metadata::jsonb, embedding
+        FROM embeddings_staging
+        ORDER BY source_id, seq DESC
+        ON CONFLICT (source_id) DO UPDATE
+        SET
+            document = EXCLUDED.document,
+            label = EXCLUDED.label,
+            media = EXCLUDED.media,
+            links = EXCLUDED.links,
+            metadata = EXCLUDED.metadata,
+            embedding = EXCLUDED.embedding
+        """
+    )
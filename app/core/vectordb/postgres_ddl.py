@@ -0,0 +1,111 @@
+"""One-time schema setup for the postgres vector store"""
+import os
+import threading
+
+from log_configs import log
+
+# Used for the document_tsv column when it is created, and for parsing the queries against it
+TEXT_SEARCH_CONFIG = os.getenv("POSTGRES_DB_TEXT_SEARCH_CONFIG", "english")
+
+_bootstrapped = set()
+_bootstrap_lock = threading.Lock()
+
+
+def bootstrap_database(db_conn, db_key: tuple, embedding_vector_size: int) -> None:
+    """Installs pgvector and creates the tables, if it hasn't been done yet in this process
+    for the database identified by db_key"""
+    if db_key in _bootstrapped:
+        return
+    with _bootstrap_lock:
+        if db_key in _bootstrapped:
+            return
+        log.info(
+            "Setting up %s with PGVector embedding dimension size: %s",
+            db_key,
+            embedding_vector_size,
+        )
+        cur = db_conn.cursor()
+
+        # install pgvector
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+
+        # Create table to store embeddings and metadata
+        table_create_command = f"""
+        CREATE TABLE IF NOT EXISTS embeddings (
+                    id bigserial primary key,
+                    source_id text unique,
+                    document text,
+                    label text,
+                    media text,
+                    links text,
+                    embedding vector({embedding_vector_size}),
+                    metadata jsonb
+                    );
+                    """
+        cur.execute(table_create_command)
+        # For metadata filters, which test containment with @>
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_metadata_idx "
+            "ON embeddings USING gin (metadata jsonb_path_ops)"
+        )
+        # For hybrid search. Generated, so it is kept up to date with the document
+        cur.execute(
+            "ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS document_tsv tsvector "
+            "GENERATED ALWAYS AS (to_tsvector(%s::regconfig, COALESCE(document, ''))) STORED",
+            (TEXT_SEARCH_CONFIG,),
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_document_tsv_idx "
+            "ON embeddings USING gin (document_tsv)"
+        )
+
+        # What the vector index was last built with, see postgres_index
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS vector_index_state (
+                index_name text primary key,
+                index_type text,
+                params jsonb,
+                row_count bigint,
+                built_at timestamptz,
+                build_seconds double precision,
+                storage_mode text
+            )
+            """
+        )
+        # For state tables created before storage modes
+        cur.execute(
+            "ALTER TABLE vector_index_state ADD COLUMN IF NOT EXISTS storage_mode text"
+        )
+
+        # Per-label document counts, see postgres_labels
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS label_catalog (
+                label text primary key,
+                doc_count bigint NOT NULL,
+                updated_at timestamptz NOT NULL
+            )
+            """
+        )
+        # Fill it in for data loaded before the catalog existed. Done only while the
+        # catalog is empty, so this full scan happens once per database
+        cur.execute(
+            """
+            INSERT INTO label_catalog (label, doc_count, updated_at)
+            SELECT label, COUNT(*), now() FROM embeddings
+            WHERE label IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM label_catalog)
+            GROUP BY label
+            """
+        )
+        cur.close()
+        db_conn.commit()
+        _bootstrapped.add(db_key)
+
+
+def reset_bootstrapped() -> None:
+    """Forgets which databases were set up. For when databases are dropped and
+    recreated while the app is running, like in tests"""
+    with _bootstrap_lock:
+        _bootstrapped.clear()
@@ -0,0 +1,503 @@
+"""Lifecycle of the ANN index on the embeddings table: one named index per collection,
+rebuilt concurrently only when the data has grown enough to warrant it,
+and optionally a partial index per label.
+The indexes can be on the full vectors, or on half precision or binary quantized
+copies of them, to fit in less memory. Searches then re-rank with the full vectors"""
+import hashlib
+import json
+import math
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Hashable, Iterable, List, Optional, Tuple
+
+from psycopg2 import sql
+
+from log_configs import log
+
+INDEX_TYPE = os.getenv("POSTGRES_DB_INDEX_TYPE", "hnsw").lower()
+INDEX_MIN_ROWS = int(os.getenv("POSTGRES_DB_INDEX_MIN_ROWS", "1000"))
+INDEX_REBUILD_GROWTH = float(os.getenv("POSTGRES_DB_INDEX_REBUILD_GROWTH", "0.2"))
+LABEL_INDEXES = os.getenv("POSTGRES_DB_LABEL_INDEXES", "false").lower() == "true"
+STORAGE_MODE = os.getenv("POSTGRES_DB_STORAGE_MODE", "full").lower()
+
+# Whether uploads start an index update in the background. Without it,
+# indexes are only built through the /admin/vector-index endpoint
+INDEX_AUTO_BUILD = os.getenv("POSTGRES_DB_INDEX_AUTO_BUILD", "true").lower() == "true"
+
+INDEX_NAME = "embeddings_vector_idx"
+INDEX_TYPES = ("hnsw", "ivfflat")
+# Names postgres gave the indexes that used to be created on every upload
+LEGACY_INDEX_PATTERN = r"^embeddings_embedding_idx\d*$"
+LABEL_INDEX_PREFIX = "embeddings_label_"
+STORAGE_MODES = ("full", "halfvec", "binary")
+# How many candidates per requested result the compact index search fetches for re-ranking
+RERANK_FACTORS = {
+    "full": 1,
+    "halfvec": int(os.getenv("POSTGRES_DB_HALFVEC_RERANK_FACTOR", "2")),
+    "binary": int(os.getenv("POSTGRES_DB_BINARY_RERANK_FACTOR", "10")),
+}
+
+
+def index_expression(storage_mode: str, dimension: int) -> Tuple[str, str]:
+    """The indexed expression and its operator class for a storage mode"""
+    if storage_mode == "full":
+        return "embedding", "vector_cosine_ops"
+    if storage_mode == "halfvec":
+        return f"(embedding::halfvec({dimension}))", "halfvec_cosine_ops"
+    if storage_mode == "binary":
+        return f"(binary_quantize(embedding)::bit({dimension}))", "bit_hamming_ops"
+    raise ValueError(f"Unsupported storage mode: {storage_mode}")
+
+
+def ann_order(storage_mode: str, dimension: int, vector: str) -> str:
+    """ORDER BY expression for the first stage of a search, written so that the
+    planner matches it to index_expression. vector is the query vector's placeholder"""
+    if storage_mode == "full":
+        return f"embedding <=> {vector}"
+    if storage_mode == "halfvec":
+        return f"embedding::halfvec({dimension}) <=> {vector}::halfvec({dimension})"
+    if storage_mode == "binary":
+        return (
+            f"binary_quantize(embedding)::bit({dimension}) "
+            + f"<~> binary_quantize({vector})::bit({dimension})"
+        )
+    raise ValueError(f"Unsupported storage mode: {storage_mode}")
+
+
+def index_params(index_type: str, row_count: int) -> dict:
+    """Build parameters for the data size, following the pgvector guidelines"""
+    if index_type == "ivfflat":
+        if row_count <= 1_000_000:
+            lists = row_count // 1000
+        else:
+            lists = int(math.sqrt(row_count))
+        return {"lists": max(10, lists)}
+    if index_type == "hnsw":
+        if row_count <= 1_000_000:
+            return {"m": 16, "ef_construction": 64}
+        return {"m": 24, "ef_construction": 128}
+    raise ValueError(f"Unsupported index type: {index_type}")
+
+
+# ivfflat.probes and hnsw.ef_search per schema.SearchEffort value.
+# Both are set, so that either index type is covered
+SEARCH_EFFORT_SETTINGS = {
+    "fast": {"ivfflat.probes": 1, "hnsw.ef_search": 40},
+    "balanced": {"ivfflat.probes": 10, "hnsw.ef_search": 100},
+    "high-recall": {"ivfflat.probes": 40, "hnsw.ef_search": 400},
+}
+
+
+def search_settings(effort: str, query_limit: int) -> dict:
+    """The index settings for a search effort. hnsw can't return more rows than
+    ef_search, so that is kept at least at the query limit"""
+    settings = dict(SEARCH_EFFORT_SETTINGS[effort])
+    settings["hnsw.ef_search"] = min(1000, max(settings["hnsw.ef_search"], query_limit))
+    return settings
+
+
+def _index_exists(cur, name: str) -> bool:
+    """Whether a valid index of that name is on the embeddings table"""
+    cur.execute(
+        """
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND i.indisvalid
+        """,
+        (name,),
+    )
+    return cur.fetchone() is not None
+
+
+def _legacy_indexes(cur) -> list:
+    """Unnamed ivfflat indexes left behind by earlier versions"""
+    cur.execute(
+        """
+        SELECT indexname FROM pg_indexes
+        WHERE tablename = 'embeddings' AND indexname ~ %s
+        """,
+        (LEGACY_INDEX_PATTERN,),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def _embedding_dimension(cur) -> int:
+    """The declared size of the embedding column"""
+    cur.execute(
+        """
+        SELECT atttypmod FROM pg_attribute
+        WHERE attrelid = 'embeddings'::regclass AND attname = 'embedding'
+        """
+    )
+    return cur.fetchone()[0]
+
+
+# db key -> storage mode of the main index, None if it has none. Looked up once per
+# database, and updated by the index swap in this process
+_BUILT_MODES = {}
+
+
+def known_storage_mode(db_conn, db_key: Hashable) -> Optional[str]:
+    """built_storage_mode, looked up only the first time for each database"""
+    if db_key not in _BUILT_MODES:
+        _BUILT_MODES[db_key] = built_storage_mode(db_conn)
+    return _BUILT_MODES[db_key]
+
+
+def indexed_storage_mode(db_key: Hashable) -> Optional[str]:
+    """The storage mode of the main index as known in this process, without a query"""
+    return _BUILT_MODES.get(db_key)
+
+
+def forget_storage_modes() -> None:
+    """For when databases are dropped and recreated while the app is running, like in tests"""
+    _BUILT_MODES.clear()
+
+
+def built_storage_mode(db_conn) -> Optional[str]:
+    """Storage mode of the main index, or None if there is no valid one.
+    Cheaper than get_index_status, as it doesn't count the rows"""
+    cur = db_conn.cursor()
+    cur.execute(
+        "SELECT COALESCE(storage_mode, 'full') FROM vector_index_state "
+        + "WHERE index_name = %s",
+        (INDEX_NAME,),
+    )
+    state = cur.fetchone()
+    exists = _index_exists(cur, INDEX_NAME)
+    cur.close()
+    db_conn.commit()
+    return state[0] if state is not None and exists else None
+
+
+def get_index_status(
+    db_conn, index_type: str = INDEX_TYPE, storage_mode: str = STORAGE_MODE
+) -> dict:
+    """What is built, for how many rows, and whether a rebuild is due"""
+    cur = db_conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM embeddings")
+    row_count = cur.fetchone()[0]
+    cur.execute(
+        """
+        SELECT index_type, params, row_count, built_at, build_seconds,
+            COALESCE(storage_mode, 'full')
+        FROM vector_index_state WHERE index_name = %s
+        """,
+        (INDEX_NAME,),
+    )
+    state = cur.fetchone()
+    exists = _index_exists(cur, INDEX_NAME)
+    legacy = _legacy_indexes(cur)
+    cur.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'embeddings' "
+        + "AND starts_with(indexname, %s) ORDER BY indexname",
+        (LABEL_INDEX_PREFIX,),
+    )
+    label_indexes = [row[0] for row in cur.fetchall()]
+    cur.close()
+    db_conn.commit()
+
+    status = {
+        "index_name": INDEX_NAME,
+        "configured_type": index_type,
+        "configured_storage_mode": storage_mode,
+        "exists": exists,
+        "row_count": row_count,
+        "min_rows": INDEX_MIN_ROWS,
+        "rebuild_growth": INDEX_REBUILD_GROWTH,
+        "legacy_indexes": legacy,
+        "label_indexes": label_indexes,
+        "index_type": None,
+        "storage_mode": None,
+        "params": None,
+        "indexed_rows": None,
+        "built_at": None,
+        "build_seconds": None,
+    }
+    if state is not None:
+        status["index_type"] = state[0]
+        status["params"] = state[1]
+        status["indexed_rows"] = state[2]
+        status["built_at"] = state[3].isoformat() if state[3] else None
+        status["build_seconds"] = state[4]
+        status["storage_mode"] = state[5]
+
+    if row_count < INDEX_MIN_ROWS:
+        # An exact scan is fast enough, and ivfflat lists trained on little data recall poorly
+        status["needs_rebuild"] = False
+    elif (
+        not exists
+        or state is None
+        or state[0] != index_type
+        or state[5] != storage_mode
+    ):
+        status["needs_rebuild"] = True
+    else:
+        growth = (row_count - state[2]) / max(state[2], 1)
+        status["needs_rebuild"] = growth >= INDEX_REBUILD_GROWTH
+    return status
+
+
+def rebuild_index(
+    db_conn,
+    index_type: str = INDEX_TYPE,
+    force: bool = False,
+    storage_mode: str = STORAGE_MODE,
+    db_key: Hashable = None,
+) -> dict:
+    """Builds the index under a temporary name with CREATE INDEX CONCURRENTLY and swaps
+    it in, so reads and writes go on meanwhile. Without force, only builds if
+    get_index_status says it is due. Legacy indexes, and label indexes of another
+    storage mode, are dropped either way. Only one process builds at a time per database.
+    db_key identifies the database for known_storage_mode"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {index_type}")
+    if storage_mode not in STORAGE_MODES:
+        raise ValueError(f"Unsupported storage mode: {storage_mode}")
+    status = get_index_status(db_conn, index_type, storage_mode)
+    build = force or status["needs_rebuild"]
+    stale = status["legacy_indexes"] + [
+        name
+        for name in status["label_indexes"]
+        if not re.match(_label_index_pattern(storage_mode), name)
+    ]
+    if not build and not stale:
+        return status
+
+    with _build_lock(db_conn) as cur:
+        if cur is None:
+            return status
+        for old_name in stale:
+            cur.execute(
+                sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(
+                    sql.Identifier(old_name)
+                )
+            )
+        if build:
+            _build(cur, index_type, status["row_count"], storage_mode)
+            if db_key is not None:
+                _BUILT_MODES[db_key] = storage_mode
+    return get_index_status(db_conn, index_type, storage_mode)
+
+
+@contextmanager
+def _build_lock(db_conn):
+    """Yields an autocommit cursor, as CONCURRENTLY can't run inside a transaction block,
+    while holding the lock for index builds in this database.
+    Yields None if another process holds it"""
+    cur = db_conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (INDEX_NAME,))
+    locked = cur.fetchone()[0]
+    db_conn.commit()
+    if not locked:
+        cur.close()
+        log.info("Another process is building vector indexes, skipping")
+        yield None
+        return
+    try:
+        db_conn.autocommit = True
+        yield cur
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (INDEX_NAME,))
+        cur.close()
+        db_conn.autocommit = False
+
+
+def _label_index_tag(storage_mode: str) -> str:
+    """Part of a label index name telling its storage mode. Empty for full vectors"""
+    return "" if storage_mode == "full" else storage_mode + "_"
+
+
+def _label_index_pattern(storage_mode: str) -> str:
+    """Matches the names of label indexes of a storage mode"""
+    return f"^{LABEL_INDEX_PREFIX}{_label_index_tag(storage_mode)}[0-9a-f]{{16}}_idx$"
+
+
+def label_index_name(label: str, storage_mode: str = STORAGE_MODE) -> str:
+    """Labels can be any text, so the index is named by a hash of it"""
+    return (
+        LABEL_INDEX_PREFIX
+        + _label_index_tag(storage_mode)
+        + hashlib.md5(label.encode("utf-8")).hexdigest()[:16]
+        + "_idx"
+    )
+
+
+def ensure_label_indexes(
+    db_conn, labels: Iterable[str], storage_mode: str = STORAGE_MODE
+) -> List[str]:
+    """Creates a partial index, WHERE label = <label>, for each label that doesn't
+    have one yet, and returns the labels indexed. These are hnsw irrespective of
+    INDEX_TYPE, since hnsw needs no training data and so is good from a label's first upload.
+    A label whose index is being built by another process is left to a later upload"""
+    cur = db_conn.cursor()
+    missing = [
+        label
+        for label in sorted({label for label in labels if label is not None})
+        if not _index_exists(cur, label_index_name(label, storage_mode))
+    ]
+    expression, opclass = index_expression(storage_mode, _embedding_dimension(cur))
+    cur.close()
+    db_conn.commit()
+    if not missing:
+        return []
+    params = index_params("hnsw", 0)
+    with _build_lock(db_conn) as cur:
+        if cur is None:
+            return []
+        for label in missing:
+            name = label_index_name(label, storage_mode)
+            log.info("Building partial index %s for label %s", name, label)
+            # An interrupted concurrent build leaves an invalid index behind
+            cur.execute(
+                sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(
+                    sql.Identifier(name)
+                )
+            )
+            cur.execute(
+                sql.SQL(
+                    "CREATE INDEX CONCURRENTLY {} ON embeddings "
+                    "USING hnsw ({} {}) "
+                    "WITH (m = {}, ef_construction = {}) WHERE label = {}"
+                ).format(
+                    sql.Identifier(name),
+                    sql.SQL(expression),
+                    sql.SQL(opclass),
+                    sql.Literal(params["m"]),
+                    sql.Literal(params["ef_construction"]),
+                    sql.Literal(label),
+                )
+            )
+    return missing
+
+
+def _build(cur, index_type: str, row_count: int, storage_mode: str) -> None:
+    """Creates the new index next to the old one, then swaps them. Needs autocommit"""
+    params = index_params(index_type, row_count)
+    expression, opclass = index_expression(storage_mode, _embedding_dimension(cur))
+    new_name = INDEX_NAME + "_new"
+    log.info(
+        "Building %s %s index %s on %s rows with %s",
+        index_type,
+        storage_mode,
+        INDEX_NAME,
+        row_count,
+        params,
+    )
+    start = time.perf_counter()
+    # An interrupted concurrent build leaves an invalid index behind
+    cur.execute(
+        sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(
+            sql.Identifier(new_name)
+        )
+    )
+    cur.execute(
+        sql.SQL(
+            "CREATE INDEX CONCURRENTLY {} ON embeddings "
+            "USING {} ({} {}) WITH ({})"
+        ).format(
+            sql.Identifier(new_name),
+            sql.SQL(index_type),
+            sql.SQL(expression),
+            sql.SQL(opclass),
+            sql.SQL(", ").join(
+                sql.SQL("{} = {}").format(sql.SQL(key), sql.Literal(value))
+                for key, value in params.items()
+            ),
+        )
+    )
+    # The old index is renamed out of the way in the same transaction as the new one
+    # takes its name, so searches always have an index, and is dropped only after that
+    old_name = INDEX_NAME + "_old"
+    cur.execute(
+        sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(old_name))
+    )
+    cur.execute("BEGIN")
+    cur.execute(
+        sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+            sql.Identifier(INDEX_NAME), sql.Identifier(old_name)
+        )
+    )
+    cur.execute(
+        sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+            sql.Identifier(new_name), sql.Identifier(INDEX_NAME)
+        )
+    )
+    cur.execute("COMMIT")
+    cur.execute(
+        sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(old_name))
+    )
+    build_seconds = time.perf_counter() - start
+    cur.execute(
+        """
+        INSERT INTO vector_index_state
+            (index_name, index_type, storage_mode, params, row_count, built_at, build_seconds)
+        VALUES (%s, %s, %s, %s, %s, now(), %s)
+        ON CONFLICT (index_name) DO UPDATE
+        SET
+            index_type = EXCLUDED.index_type,
+            storage_mode = EXCLUDED.storage_mode,
+            params = EXCLUDED.params,
+            row_count = EXCLUDED.row_count,
+            built_at = EXCLUDED.built_at,
+            build_seconds = EXCLUDED.build_seconds
+        """,
+        (
+            INDEX_NAME,
+            index_type,
+            storage_mode,
+            json.dumps(params),
+            row_count,
+            build_seconds,
+        ),
+    )
+    log.info("Built %s in %.1f seconds", INDEX_NAME, build_seconds)
+
+
+_PENDING_UPDATES = {}  # collection key -> labels uploaded since the update was scheduled
+_PENDING_LOCK = threading.Lock()
+_BUILDER = None
+
+
+def schedule_index_update(
+    collection_key: Hashable, labels: Iterable[str], update: Callable[[set], None]
+) -> None:
+    """Marks a collection's indexes as possibly stale after an upload, and has
+    update(labels) run on the background builder thread. Uploads made while an update
+    is waiting are folded into it, so a burst of uploads leads to one update"""
+    global _BUILDER  # pylint: disable=global-statement
+    if not INDEX_AUTO_BUILD:
+        return
+    with _PENDING_LOCK:
+        waiting = collection_key in _PENDING_UPDATES
+        _PENDING_UPDATES.setdefault(collection_key, set()).update(labels)
+        if waiting:
+            return
+        if _BUILDER is None:
+            _BUILDER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vector-index")
+        _BUILDER.submit(_run_update, collection_key, update)
+
+
+def _run_update(collection_key: Hashable, update: Callable[[set], None]) -> None:
+    """Runs a scheduled update with the labels gathered till it started"""
+    with _PENDING_LOCK:
+        labels = _PENDING_UPDATES.pop(collection_key, set())
+    try:
+        update(labels)
+    except Exception as exe:  # pylint: disable=broad-except
+        # The data is in, and the index can be rebuilt from /admin/vector-index
+        log.exception("While updating the vector index: %s", exe)
+
+
+def stop_index_updates() -> None:
+    """Drops the updates not started yet and waits for the running one,
+    like on app shutdown or before dropping a database"""
+    global _BUILDER  # pylint: disable=global-statement
+    with _PENDING_LOCK:
+        builder, _BUILDER = _BUILDER, None
+        _PENDING_UPDATES.clear()
+    if builder is not None:
+        builder.shutdown(wait=True, cancel_futures=True)
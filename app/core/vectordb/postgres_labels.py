@@ -0,0 +1,59 @@
+"""The label catalog of the postgres vector store: document counts and last update per label,
+kept up to date on ingest so that listing the labels doesn't scan the embeddings"""
+from collections import Counter
+from typing import Iterable, List
+
+from psycopg2.extras import execute_values
+
+CATALOG_LOCK = "label_catalog"
+
+
+def lock_label_catalog(cur) -> None:
+    """Serializes ingests until the end of the caller's transaction, so that the labels
+    read by one of them before its upsert aren't changed by another meanwhile"""
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (CATALOG_LOCK,))
+
+
+def existing_labels(cur, source_ids: List[str]) -> List[str]:
+    """Labels of the rows with these source_ids, that an upsert is about to overwrite"""
+    cur.execute(
+        "SELECT label FROM embeddings WHERE source_id = ANY(%s)", (list(source_ids),)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def update_label_catalog(
+    cur, old_labels: Iterable[str], new_labels: Iterable[str]
+) -> None:
+    """Applies the change in counts of an upsert that replaced rows with old_labels
+    by rows with new_labels. Labels left without documents are removed"""
+    counts = Counter(label for label in new_labels if label is not None)
+    counts.subtract(label for label in old_labels if label is not None)
+    if not counts:
+        return
+    execute_values(
+        cur,
+        """
+        INSERT INTO label_catalog (label, doc_count, updated_at)
+        VALUES %s
+        ON CONFLICT (label) DO UPDATE
+        SET
+            doc_count = label_catalog.doc_count + EXCLUDED.doc_count,
+            updated_at = EXCLUDED.updated_at
+        """,
+        list(counts.items()),
+        template="(%s, %s, now())",
+    )
+    cur.execute(
+        "DELETE FROM label_catalog WHERE label = ANY(%s) AND doc_count <= 0",
+        (list(counts),),
+    )
+
+
+def get_label_catalog(cur) -> List[dict]:
+    """All labels with their document counts and when they were last written to"""
+    cur.execute("SELECT label, doc_count, updated_at FROM label_catalog ORDER BY label")
+    return [
+        {"label": label, "doc_count": doc_count, "updated_at": updated_at}
+        for label, doc_count, updated_at in cur.fetchall()
+    ]
@@ -0,0 +1,309 @@
+"""Process wide connection pools for the postgres vector store"""
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import asyncpg
+import psycopg2
+import psycopg2.extensions
+from pgvector.asyncpg import register_vector
+
+from custom_exceptions import PostgresException
+from log_configs import log
+
+POOL_MIN_SIZE = int(os.getenv("POSTGRES_DB_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("POSTGRES_DB_POOL_MAX_SIZE", "10"))
+POOL_TIMEOUT = float(os.getenv("POSTGRES_DB_POOL_TIMEOUT", "30"))
+POOL_MAX_IDLE = float(os.getenv("POSTGRES_DB_POOL_MAX_IDLE", "300"))
+POOL_CHECK_AFTER = float(os.getenv("POSTGRES_DB_POOL_CHECK_AFTER", "30"))
+# How often idle connections are expired and min_size topped up, in the background
+POOL_MAINTENANCE_INTERVAL = float(os.getenv("POSTGRES_DB_POOL_MAINTENANCE_INTERVAL", "10"))
+
+
+class PooledConnection(psycopg2.extensions.connection):  # pylint: disable=too-few-public-methods
+    """psycopg2 connection that can carry per-connection setup state"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vector_registered = False
+        self.prepared = OrderedDict()  # statements prepared on it, least recently used first
+
+
+class ConnectionPool:  # pylint: disable=too-many-instance-attributes
+    """Thread safe pool of connections to one database.
+    Connections idle for longer than check_after are pinged before being handed out,
+    those idle for longer than max_idle are closed (keeping min_size open),
+    and callers wait at most timeout seconds for a free connection"""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        connect_kwargs: dict,
+        min_size: int = POOL_MIN_SIZE,
+        max_size: int = POOL_MAX_SIZE,
+        timeout: float = POOL_TIMEOUT,
+        max_idle: float = POOL_MAX_IDLE,
+        check_after: float = POOL_CHECK_AFTER,
+    ) -> None:
+        """Sets the limits. min_size connections are opened by fill,
+        the others as they are needed"""
+        self.connect_kwargs = connect_kwargs
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.idle = deque()  # (connection, time it was returned)
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def _connect(self) -> PooledConnection:
+        """Opens a new connection"""
+        return psycopg2.connect(connection_factory=PooledConnection, **self.connect_kwargs)
+
+    def _close_expired(self) -> None:
+        """Closes connections idle for too long. Called with the lock held"""
+        now = time.monotonic()
+        while self.idle and self.size > self.min_size:
+            conn, returned_at = self.idle[0]
+            if now - returned_at < self.max_idle:
+                break
+            self.idle.popleft()
+            self.size -= 1
+            conn.close()
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        """Pings the server on the connection"""
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def fill(self) -> None:
+        """Opens connections till min_size are open. A failure is logged,
+        and tried again on the next maintenance round"""
+        while True:
+            with self.cond:
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                conn = self._connect()
+            except Exception as exe:  # pylint: disable=broad-except
+                self._discard()
+                log.warning("While opening a pooled connection: %s", exe)
+                return
+            self.putconn(conn)
+
+    def maintain(self) -> None:
+        """Closes the connections idle for too long and reopens up to min_size.
+        Run periodically by the maintenance thread, so that this doesn't wait for a checkout"""
+        with self.cond:
+            self._close_expired()
+        self.fill()
+
+    def _check_open(self) -> None:
+        """Refuses to hand out connections after closeall. Called with the lock held"""
+        if self.closed:
+            raise PostgresException("The connection pool is closed")
+
+    def getconn(self) -> PooledConnection:
+        """Checks out a connection, waiting if all of them are in use"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.cond:
+                self._check_open()
+                self._close_expired()
+                while not self.idle and self.size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.cond.wait(remaining):
+                        raise PostgresException(
+                            f"No free connection in the pool after {self.timeout} seconds"
+                        )
+                    self._check_open()
+                if self.idle:
+                    # Most recently used first, so that the rest can expire
+                    conn, returned_at = self.idle.pop()
+                else:
+                    conn, returned_at = None, None
+                    self.size += 1
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._discard()
+                    raise
+            if not conn.closed and (
+                time.monotonic() - returned_at < self.check_after or self._is_healthy(conn)
+            ):
+                return conn
+            log.warning("Discarding a broken connection from the pool")
+            conn.close()
+            self._discard()
+
+    def _discard(self) -> None:
+        """Frees the slot of a connection that was closed"""
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def putconn(self, conn: PooledConnection) -> None:
+        """Returns a connection to the pool, ending any transaction left open"""
+        if not conn.closed:
+            try:
+                if (
+                    conn.get_transaction_status()
+                    != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                ):
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        if self.closed and not conn.closed:
+            conn.close()
+        if conn.closed:
+            self._discard()
+            return
+        with self.cond:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection for the duration of a with block"""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self) -> None:
+        """Closes the idle connections. Checked out ones are closed upon their return,
+        and callers waiting for a connection get an error"""
+        with self.cond:
+            self.closed = True
+            while self.idle:
+                conn, _ = self.idle.pop()
+                conn.close()
+                self.size -= 1
+            self.cond.notify_all()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_MAINTAINER = None
+_MAINTAINER_STOP = threading.Event()
+
+
+def _maintainer_loop() -> None:
+    """Maintains every pool once per POOL_MAINTENANCE_INTERVAL"""
+    while not _MAINTAINER_STOP.wait(POOL_MAINTENANCE_INTERVAL):
+        with _pools_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            pool.maintain()
+
+
+def _start_maintainer() -> None:
+    """Starts the maintenance thread, if it isn't running. Called with the pools lock held"""
+    global _MAINTAINER  # pylint: disable=global-statement
+    if _MAINTAINER is None or not _MAINTAINER.is_alive():
+        _MAINTAINER_STOP.clear()
+        _MAINTAINER = threading.Thread(
+            target=_maintainer_loop, name="postgres-pool-maintenance", daemon=True
+        )
+        _MAINTAINER.start()
+
+
+def get_pool(host, port, dbname, user, password) -> ConnectionPool:
+    """The shared pool for a (host, port, db, user), with min_size connections
+    opened when it is created"""
+    key = (host, str(port), dbname, user)
+    with _pools_lock:
+        created = key not in _pools
+        if created:
+            _pools[key] = ConnectionPool(
+                {
+                    "host": host,
+                    "port": port,
+                    "dbname": dbname,
+                    "user": user,
+                    "password": password,
+                }
+            )
+            _start_maintainer()
+        pool = _pools[key]
+    if created:
+        pool.fill()
+    return pool
+
+
+def close_all_pools() -> None:
+    """Closes all pools and stops their maintenance,
+    like on app shutdown or before dropping a database"""
+    global _MAINTAINER  # pylint: disable=global-statement
+    _MAINTAINER_STOP.set()
+    if _MAINTAINER is not None:
+        _MAINTAINER.join()
+        _MAINTAINER = None
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+_async_pools = {}
+
+
+async def get_async_pool(host, port, dbname, user, password) -> asyncpg.Pool:
+    """The shared asyncpg pool for a (host, port, db, user) on the running event loop.
+    Every connection in it has the vector type registered"""
+    loop = asyncio.get_running_loop()
+    key = (host, str(port), dbname, user, loop)
+    with _pools_lock:
+        for stale in [key for key in _async_pools if key[-1].is_closed()]:
+            del _async_pools[stale]
+        if key not in _async_pools:
+            _async_pools[key] = loop.create_task(
+                asyncpg.create_pool(
+                    host=host,
+                    port=int(port),
+                    database=dbname,
+                    user=user,
+                    password=password,
+                    min_size=POOL_MIN_SIZE,
+                    max_size=POOL_MAX_SIZE,
+                    max_inactive_connection_lifetime=POOL_MAX_IDLE,
+                    timeout=POOL_TIMEOUT,
+                    init=register_vector,
+                )
+            )
+        creating = _async_pools[key]
+    try:
+        return await creating
+    except Exception:
+        with _pools_lock:
+            if _async_pools.get(key) is creating:
+                del _async_pools[key]
+        raise
+
+
+async def close_all_async_pools() -> None:
+    """Closes the asyncpg pools of the running event loop"""
+    loop = asyncio.get_running_loop()
+    with _pools_lock:
+        keys = [key for key in _async_pools if key[-1] is loop]
+        creating = [_async_pools.pop(key) for key in keys]
+    for task in creating:
+        try:
+            pool = await task
+        except Exception:  # pylint: disable=broad-except
+            continue
+        await pool.close()
@@ -0,0 +1,82 @@
+"""Bounded, TTL-aware caches for chat queries, shared by the vector DB implementations"""
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "600"))
+
+
+def normalize_query(query: str) -> str:
+    """Lower-cases and drops punctuation and extra spaces,
+    so "What is grace?" and "what is grace" share an entry"""
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after ttl seconds. Keys are tuples whose
+    first item identifies the collection, so that writes can invalidate them"""
+
+    def __init__(
+        self, max_items: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL
+    ) -> None:
+        """Sets the size and age limits"""
+        self.max_items = max_items
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0}
+
+    def get(self, key: Hashable) -> Optional[object]:
+        """Returns the cached value, or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key: Hashable, value: object) -> None:
+        """Stores a value, dropping the least recently used entries beyond the size limit"""
+        if self.max_items <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, collection_key: Hashable) -> None:
+        """Drops all entries for a collection"""
+        with self.lock:
+            stale = [key for key in self.entries if key[0] == collection_key]
+            for key in stale:
+                del self.entries[key]
+            self.stats["invalidated"] += len(stale)
+
+    def get_stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["items"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+# Query vectors only depend on the model, so they are never invalidated by writes.
+# Retrieval results are invalidated when the collection they came from is written to.
+# Writes from other worker processes are not seen, so those entries live till their TTL.
+query_embedding_cache = TTLCache()
+retrieval_cache = TTLCache()
@@ -7,6 +7,10 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.embedding.worker_pool import shutdown_pools
+from core.vectordb.postgres_pool import close_all_pools, close_all_async_pools
+from core.vectordb.postgres_index import stop_index_updates
+from core.vectordb.chroma_clients import close_all_clients
 
 from log_configs import log
 import routers
@@ -37,6 +41,17 @@ async def startup_event():
     SentenceTransformerEmbedding()  # instantiate once to download the model
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release resources held across requests"""
+    log.info("App is shutting down...")
+    shutdown_pools()
+    stop_index_updates()
+    close_all_pools()
+    await close_all_async_pools()
+    close_all_clients()
+
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     """Place to define common logging for all API calls"""
@@ -15,6 +15,7 @@ from fastapi import (
     Form,
     HTTPException,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import SecretStr
@@ -33,6 +34,10 @@ from core.vectordb.chroma import Chroma
 from core.vectordb.postgres4langchain import Postgres
 from core.embedding.openai import OpenAIEmbedding
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.embedding.quantized import QuantizedSentenceTransformerEmbedding
+from core.embedding.cache import get_default_cache
+from core.vectordb.retrieval_cache import query_embedding_cache, retrieval_cache
+from core.vectordb.chroma_clients import get_persist_stats
 from custom_exceptions import PermissionException, GenericException, ChatErrorResponse
 
 router = APIRouter()
@@ -192,19 +197,32 @@ def compose_vector_db_args(db_type, settings, embedding_config):
             + "setting embedding type to %s",
             embedding_config.embeddingType,
         )
-        if embedding_config.embeddingType == schema.EmbeddingType.HUGGINGFACE_DEFAULT:
-            vectordb_args["embedding"] = SentenceTransformerEmbedding()
-        elif (
-            embedding_config.embeddingType
-            == schema.EmbeddingType.HUGGINGFACE_MULTILINGUAL
-        ):
-            vectordb_args["embedding"] = SentenceTransformerEmbedding(
-                model="sentence-transformers/LaBSE"
-            )
-        elif embedding_config.embeddingType == schema.EmbeddingType.OPENAI:
-            vectordb_args["embedding"] = OpenAIEmbedding()
-        else:
-            raise GenericException("This embedding type is not supported (yet)!")
+    # Chroma needs it too, to embed queries with the model the collection was built with
+    if embedding_config.embeddingType == schema.EmbeddingType.HUGGINGFACE_DEFAULT:
+        vectordb_args["embedding"] = SentenceTransformerEmbedding()
+    elif (
+        embedding_config.embeddingType
+        == schema.EmbeddingType.HUGGINGFACE_MULTILINGUAL
+    ):
+        vectordb_args["embedding"] = SentenceTransformerEmbedding(
+            model="sentence-transformers/LaBSE"
+        )
+    elif (
+        embedding_config.embeddingType
+        == schema.EmbeddingType.HUGGINGFACE_DEFAULT_QUANTIZED
+    ):
+        vectordb_args["embedding"] = QuantizedSentenceTransformerEmbedding()
+    elif (
+        embedding_config.embeddingType
+        == schema.EmbeddingType.HUGGINGFACE_MULTILINGUAL_QUANTIZED
+    ):
+        vectordb_args["embedding"] = QuantizedSentenceTransformerEmbedding(
+            model="sentence-transformers/LaBSE"
+        )
+    elif embedding_config.embeddingType == schema.EmbeddingType.OPENAI:
+        vectordb_args["embedding"] = OpenAIEmbedding()
+    else:
+        raise GenericException("This embedding type is not supported (yet)!")
 
     return vectordb_args
 
@@ -235,6 +253,9 @@ async def websocket_chat_endpoint(
         schema.EmbeddingSelector(embeddingType=settings.embeddingType),
     )
     vectordb_args["labels"] = labels
+    vectordb_args["search_effort"] = settings.searchEffort
+    vectordb_args["search_mode"] = settings.searchMode
+    vectordb_args["metadata_filter"] = settings.metadataFilter
 
     chat_stack.set_vectordb(settings.vectordbType, **vectordb_args)
     llm_args = {}
@@ -288,7 +309,7 @@ async def websocket_chat_endpoint(
                 translation_response = translate_text(question)
                 english_query_text = translation_response["TranslatedText"]
                 query_language = translation_response["language"]
-                bot_response = chat_stack.llm_framework.generate_text(
+                bot_response = await chat_stack.llm_framework.agenerate_text(
                     query=english_query_text,
                     chat_history=chat_stack.chat_history,
                     response_language=query_language,
@@ -329,8 +350,6 @@ async def websocket_chat_endpoint(
             await websocket.send_json(resp.dict())
             break
         except WebSocketDisconnect:
-            if isinstance(chat_stack.vectordb, Chroma):
-                chat_stack.vectordb.db_client.persist()
             log.info("websocket disconnect")
             break
         except Exception as exe:  # pylint: disable=broad-exception-caught
@@ -383,7 +402,7 @@ async def upload_sentences(
         embedding_config.embeddingModelName,
     )
     # FIXME: This may have to be a background job!!!
-    data_stack.embedding.get_embeddings(doc_list=document_objs)
+    await data_stack.embedding.aget_embeddings(doc_list=document_objs)
 
     # FIXME: This may have to be a background job!!!
     data_stack.vectordb.add_to_collection(docs=document_objs)
@@ -450,7 +469,7 @@ async def upload_text_file(  # pylint: disable=too-many-arguments
         embedding_config.embeddingModelName,
     )
     # FIXME: This may have to be a background job!!!
-    data_stack.embedding.get_embeddings(doc_list=docs)
+    await data_stack.embedding.aget_embeddings(doc_list=docs)
     data_stack.vectordb.add_to_collection(docs=docs)
     return {"message": "Documents added to DB"}
 
@@ -518,7 +537,7 @@ async def upload_pdf_file(  # pylint: disable=too-many-arguments
         embedding_config.embeddingModelName,
     )
     # FIXME: This may have to be a background job!!!
-    data_stack.embedding.get_embeddings(doc_list=docs)
+    await data_stack.embedding.aget_embeddings(doc_list=docs)
     data_stack.vectordb.add_to_collection(docs=docs)
     return {"message": "Documents added to DB"}
 
@@ -579,7 +598,7 @@ async def upload_csv_file(  # pylint: disable=too-many-arguments
         embedding_config.embeddingModelName,
     )
     # FIXME: This may have to be a background job!!!
-    data_stack.embedding.get_embeddings(doc_list=docs)
+    await data_stack.embedding.aget_embeddings(doc_list=docs)
     data_stack.vectordb.add_to_collection(docs=docs)
     return {"message": "Documents added to DB"}
 
@@ -649,6 +668,114 @@ async def get_source_tags(
     return vectordb.get_available_labels()
 
 
+@router.get(
+    "/admin/cache-stats",
+    response_model=dict,
+    responses={
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse},
+    },
+    status_code=200,
+    tags=["Data Management"],
+)
+@auth_service.admin_auth_check_decorator
+async def get_cache_stats(
+    token: SecretStr = Query(
+        None, desc="Optional access token to be used if user accounts not present"
+    ),
+):
+    """Returns hit-rates and sizes of the embedding and retrieval caches of this worker"""
+    log.info("Access token used: %s", token)
+    return {
+        "embedding_cache": get_default_cache().get_stats(),
+        "query_embedding_cache": query_embedding_cache.get_stats(),
+        "retrieval_cache": retrieval_cache.get_stats(),
+    }
+
+
+@router.get(
+    "/admin/chroma-persistence",
+    response_model=List[dict],
+    responses={
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse},
+    },
+    status_code=200,
+    tags=["Data Management"],
+)
+@auth_service.admin_auth_check_decorator
+async def get_chroma_persistence(
+    token: SecretStr = Query(
+        None, desc="Optional access token to be used if user accounts not present"
+    ),
+):
+    """Returns the unsaved rows and disk write timings of the local chroma DBs
+    open in this worker"""
+    log.info("Access token used: %s", token)
+    return get_persist_stats()
+
+
+@router.get(
+    "/admin/vector-index",
+    response_model=dict,
+    responses={
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse},
+    },
+    status_code=200,
+    tags=["Data Management"],
+)
+@auth_service.admin_auth_check_decorator
+async def get_vector_index(
+    settings: schema.DBSelector = Depends(schema.DBSelector),
+    embedding_config: schema.EmbeddingSelector = Depends(schema.EmbeddingSelector),
+    token: SecretStr = Query(
+        None, desc="Optional access token to be used if user accounts not present"
+    ),
+):
+    """Returns the type, build parameters and row counts of the vector index in
+    a Postgres collection, and whether it is due for a rebuild"""
+    log.info("Access token used: %s", token)
+    args = compose_vector_db_args(
+        schema.DatabaseType.POSTGRES, settings, embedding_config
+    )
+    vectordb = Postgres(**args)
+    return await run_in_threadpool(vectordb.get_index_status)
+
+
+@router.post(
+    "/admin/vector-index",
+    response_model=dict,
+    responses={
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse},
+    },
+    status_code=200,
+    tags=["Data Management"],
+)
+@auth_service.admin_auth_check_decorator
+async def rebuild_vector_index(
+    force: bool = Query(True, desc="Rebuild even if the data hasn't grown enough"),
+    settings: schema.DBSelector = Depends(schema.DBSelector),
+    embedding_config: schema.EmbeddingSelector = Depends(schema.EmbeddingSelector),
+    token: SecretStr = Query(
+        None, desc="Optional access token to be used if user accounts not present"
+    ),
+):
+    """Rebuilds the vector index of a Postgres collection without blocking reads or
+    writes, and returns its new status"""
+    log.info("Access token used: %s", token)
+    args = compose_vector_db_args(
+        schema.DatabaseType.POSTGRES, settings, embedding_config
+    )
+    vectordb = Postgres(**args)
+    return await run_in_threadpool(vectordb.rebuild_index, force=force)
+
+
 @router.post("/login")
 async def login(
     email=Form(..., desc="Email of the user"),
@@ -31,6 +31,8 @@ class EmbeddingType(str, Enum):
 
     HUGGINGFACE_DEFAULT = "huggingface"  # TODO: add support for multiple models ?
     HUGGINGFACE_MULTILINGUAL = "huggingface-multilingual"
+    HUGGINGFACE_DEFAULT_QUANTIZED = "huggingface-quantized"
+    HUGGINGFACE_MULTILINGUAL_QUANTIZED = "huggingface-multilingual-quantized"
     OPENAI = "OpenAI"
 
 
@@ -47,6 +49,21 @@ class DatabaseType(str, Enum):
     POSTGRES = "postgres-with-pgvector"
 
 
+class SearchEffort(str, Enum):
+    """How hard the vector index is searched, trading latency for recall"""
+
+    FAST = "fast"
+    BALANCED = "balanced"
+    HIGH_RECALL = "high-recall"
+
+
+class SearchMode(str, Enum):
+    """Whether documents are found by their embeddings alone, or also by the words in them"""
+
+    VECTOR = "vector"
+    HYBRID = "hybrid"
+
+
 class LLMFrameworkType(str, Enum):
     """Available framework types"""
 
@@ -178,6 +195,22 @@ class ChatPipelineSelector(BaseModel):
         AudioTranscriptionType.WHISPER,
         desc="The framework through which audio transcription is handled",
     )
+    searchEffort: SearchEffort = Field(
+        None,
+        desc="Recall vs latency of the vector search. "
+        + "Uses the server default (POSTGRES_DB_SEARCH_EFFORT) if not set",
+    )
+    searchMode: SearchMode = Field(
+        None,
+        desc="hybrid also finds documents by full-text search, fused with the vector ranking. "
+        + "Uses the server default (POSTGRES_DB_SEARCH_MODE) if not set",
+    )
+    metadataFilter: dict = Field(
+        None,
+        example={"book": "GEN", "testament": {"$in": ["OT"]}},
+        desc="Search only documents whose metadata has these values. "
+        + 'A key can take a value, or {"$in": [values]} to match any of them',
+    )
 
 
 # class UserPrompt(BaseModel): # not using this as we recieve string from websocket
@@ -5,6 +5,15 @@ import shutil
 import pytest
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from core.vectordb.postgres_ddl import reset_bootstrapped
+from core.vectordb.postgres_pool import close_all_pools
+from core.vectordb.postgres_index import forget_storage_modes, stop_index_updates
+from core.vectordb.chroma_clients import close_all_clients
+
+TERMINATE_STATEMENT = """
+    SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+    WHERE datname = %s AND pid <> pg_backend_pid()
+"""
 
 
 @pytest.fixture
@@ -16,10 +25,13 @@ def fresh_db():
 
     # Chroma Specific clean up
     chroma_db_path = "chromadb_store_test"
+    close_all_clients()  # a shared client would keep the deleted DB in memory
     if os.path.exists(chroma_db_path):
         shutil.rmtree(chroma_db_path)
 
     # Postgres specific cleanup
+    stop_index_updates()  # a background index build would be using the database
+    close_all_pools()  # pooled connections would block dropping the database
     pg_db_host = os.environ.get("POSTGRES_DB_HOST", "localhost")
     pg_db_port = os.environ.get("POSTGRES_DB_PORT", "5432")
     pg_db_user = os.environ.get("POSTGRES_DB_USER", "admin")
@@ -33,18 +45,25 @@ def fresh_db():
     )
     db_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
     cur = db_conn.cursor()
+    # asyncpg pools of event loops that have ended may still hold connections
+    cur.execute(TERMINATE_STATEMENT, (collection_name,))
     delete_statement = f"DROP DATABASE IF EXISTS {collection_name}"
     cur.execute(delete_statement)
     create_statement = f"CREATE DATABASE {collection_name}"
     cur.execute(create_statement)
     cur.close()
     db_conn.close()
+    reset_bootstrapped()
+    forget_storage_modes()
 
     try:
         yield {"dbPath": chroma_db_path, "collectionName": collection_name}
     finally:
+        close_all_clients()
         if os.path.exists(chroma_db_path):
             shutil.rmtree(chroma_db_path)
+        stop_index_updates()
+        close_all_pools()
         db_conn = psycopg2.connect(
             user=pg_db_user,
             password=pg_db_password,
@@ -54,6 +73,7 @@ def fresh_db():
         )
         db_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         cur = db_conn.cursor()
+        cur.execute(TERMINATE_STATEMENT, (collection_name,))
         delete_statement = f"DROP DATABASE IF EXISTS {collection_name}"
         cur.execute(delete_statement)
         cur.close()
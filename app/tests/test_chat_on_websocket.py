@@ -1,5 +1,8 @@
 """Test the chat websocket"""
 import os
+import asyncio
+from langchain.schema import Document as LangchainDocument
+from core.llm_framework.openai_vanilla import OpenAIVanilla
 from . import client
 from .test_dataupload import test_data_upload_markdown
 from .test_dataupload import test_data_upload_processed_sentences
@@ -68,3 +71,33 @@ def test_chat_based_on_translationwords(fresh_db):
         assert "heaven" in data["message"].lower()
         assert "god" in data["message"].lower()
         assert "earth" in data["message"].lower()
+
+
+class FakeRetriever:  # pylint: disable=too-few-public-methods
+    """Returns one fixed document"""
+
+    async def aget_relevant_documents(self, _query):
+        """The same document for any query"""
+        return [
+            LangchainDocument(
+                page_content="In the beginning God created the heavens and the earth.",
+                metadata={"source": "NIV GEN 1:1"},
+            )
+        ]
+
+
+def test_agenerate_text_logs_unused_arguments(mocker):
+    """Arguments agenerate_text doesn't use are logged, not passed on to the logger"""
+    mocker.patch(
+        "openai.ChatCompletion.acreate",
+        new=mocker.AsyncMock(
+            return_value={"choices": [{"message": {"content": "God"}}]}
+        ),
+    )
+    llm = OpenAIVanilla(key="dummy-key", vectordb=FakeRetriever())
+    response = asyncio.run(
+        llm.agenerate_text(
+            "Who created the earth?", [], response_language="English", source="web"
+        )
+    )
+    assert response["answer"] == "God"
@@ -1,7 +1,25 @@
 """Test connecting to test DB and uploading different types of documents"""
 
+import os
+import time
+import asyncio
+import threading
+import numpy as np
 import pytest
 from app import schema
+from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.vectordb import postgres_index
+from core.vectordb.chroma4langchain import Chroma
+from core.vectordb.chroma_clients import (
+    close_all_clients,
+    get_collection,
+    get_persist_stats,
+    get_write_lock,
+    mark_dirty,
+)
+from core.vectordb.postgres4langchain import Postgres, search_effort_setting
+from core.vectordb.retrieval_cache import retrieval_cache
+from custom_exceptions import ChromaException, GenericException
 from . import client
 
 
@@ -181,3 +199,572 @@ def test_get_lables(mocker, vectordb, fresh_db):
     assert response.status_code == 200
     for label in ["NIV bible", "translationwords", "ESV-Bible"]:
         assert label in response.json()
+
+
+@pytest.mark.parametrize(
+    "vectordb", [schema.DatabaseType.CHROMA, schema.DatabaseType.POSTGRES]
+)
+def test_get_relevant_documents_batch(mocker, vectordb, fresh_db):
+    """Batched search returns one list per query, in the order of the queries"""
+    test_data_upload_processed_sentences(mocker, vectordb, fresh_db)
+    if vectordb == schema.DatabaseType.CHROMA:
+        store = Chroma(
+            path=fresh_db["dbPath"], collection_name=fresh_db["collectionName"]
+        )
+    else:
+        store = Postgres(
+            embedding=SentenceTransformerEmbedding(),
+            collection_name=fresh_db["collectionName"],
+            labels=["NIV bible"],
+            max_cosine_distance=2,
+        )
+    queries = ["Who created the heavens and the earth?", "Let there be light"]
+    results = store.get_relevant_documents_batch(queries, labels=["NIV bible"], k=2)
+    assert len(results) == len(queries)
+    assert results[0][0].metadata["source"] == "NIV GEN 1:1"
+    assert results[1][0].metadata["source"] == "NIV GEN 1:3"
+    for docs in results:
+        assert len(docs) == 2
+        assert docs[0].metadata["distance"] <= docs[1].metadata["distance"]
+
+
+@pytest.mark.parametrize(
+    "vectordb", [schema.DatabaseType.CHROMA, schema.DatabaseType.POSTGRES]
+)
+def test_label_catalog_counts(mocker, vectordb, fresh_db):
+    """The label catalog counts each document once, even when uploaded again"""
+    test_data_upload_processed_sentences(mocker, vectordb, fresh_db)
+    test_data_upload_processed_sentences(mocker, vectordb, fresh_db)
+    if vectordb == schema.DatabaseType.CHROMA:
+        store = Chroma(
+            path=fresh_db["dbPath"], collection_name=fresh_db["collectionName"]
+        )
+    else:
+        store = Postgres(
+            embedding=SentenceTransformerEmbedding(),
+            collection_name=fresh_db["collectionName"],
+        )
+    catalog = store.get_label_catalog()
+    assert [entry["label"] for entry in catalog] == ["NIV bible"]
+    assert catalog[0]["doc_count"] == len(SENT_DATA)
+    assert catalog[0]["updated_at"]
+
+
+def test_metadata_filter(mocker, fresh_db):
+    """Postgres search only returns documents whose metadata matches the filter"""
+    mocker.patch("app.routers.Supabase.check_token",
+                 return_value={"user_id": "1111"})
+    mocker.patch("app.routers.Supabase.check_role", return_value=True)
+    docs = [
+        dict(item, metadata={"book": "GEN", "verse": num})
+        for num, item in enumerate(SENT_DATA, start=1)
+    ]
+    response = client.post(
+        "/upload/sentences",
+        params={
+            "vectordb_type": schema.DatabaseType.POSTGRES.value,
+            "token": ADMIN_TOKEN,
+            "collectionName": fresh_db["collectionName"],
+            "embeddingType": schema.EmbeddingType.HUGGINGFACE_DEFAULT.value,
+        },
+        json=docs,
+    )
+    assert response.status_code == 201, response.json()
+    store = Postgres(
+        embedding=SentenceTransformerEmbedding(),
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible"],
+        max_cosine_distance=2,
+    )
+    results = store.get_relevant_documents(
+        "Let there be light", metadata_filter={"verse": {"$in": [1, 2]}}
+    )
+    assert {doc.metadata["source"] for doc in results} == {"NIV GEN 1:1", "NIV GEN 1:2"}
+    results = store.get_relevant_documents(
+        "Let there be light", metadata_filter={"book": "EXO"}
+    )
+    assert [doc.metadata["source"] for doc in results] == ["no records found"]
+
+
+def test_metadata_filter_beyond_ef_search(mocker, fresh_db):
+    """A filtered search still finds query_limit documents, when the index holds
+    more rows than ef_search. A selective filter is ranked exactly, and otherwise
+    more candidates are fetched from the index"""
+    mocker.patch("core.vectordb.postgres_index.INDEX_AUTO_BUILD", False)
+    embedding = SentenceTransformerEmbedding()
+    store = Postgres(
+        embedding=embedding,
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible"],
+        max_cosine_distance=2,
+        search_effort=schema.SearchEffort.FAST,
+    )
+    rng = np.random.default_rng(0)
+    docs = [
+        schema.Document(
+            docId=f"doc {num}",
+            text=f"Document {num}",
+            label="NIV bible",
+            metadata={"book": "GEN" if num % 200 == 0 else "EXO", "group": num % 5},
+            embedding=rng.standard_normal(store.dimension).tolist(),
+        )
+        for num in range(1000)
+    ]
+    store.add_to_collection(docs)
+    store.rebuild_index(force=True)
+    results = store.get_relevant_documents(
+        "In the beginning", metadata_filter={"book": "GEN"}
+    )
+    assert {doc.metadata["source"] for doc in results} == {
+        f"doc {num}" for num in range(0, 1000, 200)
+    }
+    # 200 matching rows, searched through the index
+    mocker.patch("core.vectordb.postgres4langchain.FILTER_EXACT_ROWS", 0)
+    results = store.get_relevant_documents(
+        "In the beginning", metadata_filter={"group": 0}
+    )
+    assert len(results) == 10
+    assert all(int(doc.metadata["source"].split()[1]) % 5 == 0 for doc in results)
+
+
+def test_hybrid_search(mocker, fresh_db):
+    """Hybrid search finds a document by a word in it, even when the embeddings
+    are farther apart than the distance cut-off"""
+    test_data_upload_processed_sentences(
+        mocker, schema.DatabaseType.POSTGRES, fresh_db
+    )
+    store = Postgres(
+        embedding=SentenceTransformerEmbedding(),
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible"],
+        max_cosine_distance=0.01,
+    )
+    results = store.get_relevant_documents("formless")
+    assert [doc.metadata["source"] for doc in results] == ["no records found"]
+    results = store.get_relevant_documents(
+        "formless", search_mode=schema.SearchMode.HYBRID
+    )
+    assert results[0].metadata["source"] == "NIV GEN 1:2"
+
+
+def test_copy_and_insert_store_the_same_text(fresh_db):
+    """Links and media are stored as the same array text by COPY and by INSERT"""
+    embedding = SentenceTransformerEmbedding()
+    store = Postgres(embedding=embedding, collection_name=fresh_db["collectionName"])
+    links = ["https://a.com/x", "https://b.com/y?q=1,2"]
+    docs = [
+        schema.Document(docId=doc_id, text="In the beginning", links=links)
+        for doc_id in ["copied", "inserted"]
+    ]
+    embedding.get_embeddings(docs)
+    store.add_to_collection(docs[:1], use_copy=True)
+    store.add_to_collection(docs[1:], use_copy=False)
+    with store.pool.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute(
+            "SELECT source_id, media, links FROM embeddings ORDER BY source_id"
+        )
+        rows = cur.fetchall()
+        cur.close()
+    expected = ("{}", '{https://a.com/x,"https://b.com/y?q=1,2"}')
+    assert [row[1:] for row in rows] == [expected, expected]
+
+
+def test_chroma_handles_are_shared(fresh_db):
+    """Collection handles are shared by name on the same client, and chroma
+    doesn't embed texts that come without vectors"""
+    path = fresh_db["dbPath"]
+    handle = get_collection(None, None, path, "shared")
+    assert get_collection(None, None, path, "shared") is handle
+    assert get_collection(None, None, path, "other") is not handle
+    handle.add(ids=["first"], embeddings=[[1.0, 0.0]], documents=["In the beginning"])
+    with pytest.raises(ChromaException):
+        handle.add(ids=["second"], documents=["In the beginning"])
+    assert get_write_lock(path=path) is get_write_lock(path=path)
+
+
+def test_chroma_instances_share_handle(fresh_db):
+    """Chroma instances with embeddings of their own, as each request makes,
+    use the same collection handle"""
+    first = Chroma(
+        path=fresh_db["dbPath"],
+        collection_name=fresh_db["collectionName"],
+        embedding=SentenceTransformerEmbedding(),
+    )
+    second = Chroma(
+        path=fresh_db["dbPath"],
+        collection_name=fresh_db["collectionName"],
+        embedding=SentenceTransformerEmbedding(),
+    )
+    assert first.embedding is not second.embedding
+    assert first.db_conn is second.db_conn
+    assert first.label_catalog is second.label_catalog
+
+
+def test_close_all_clients_forgets_clients(fresh_db):
+    """After close_all_clients, new clients and handles are made"""
+    path = fresh_db["dbPath"]
+    lock = get_write_lock(path=path)
+    handle = get_collection(None, None, path, "shared")
+    close_all_clients()
+    assert get_write_lock(path=path) is not lock
+    assert get_collection(None, None, path, "shared") is not handle
+
+
+def _add_unsaved_row(path: str, doc_id: str) -> None:
+    """Adds a row to a local chroma DB and records it for the flusher"""
+    handle = get_collection(None, None, path, "persisted")
+    handle.add(ids=[doc_id], embeddings=[[1.0, 0.0]], documents=["In the beginning"])
+    mark_dirty(None, None, path, 1)
+
+
+def _persist_stats(path: str, wait: float = 0) -> dict:
+    """The persistence stats of a local DB, after waiting up to wait seconds
+    for its unsaved rows to be written"""
+    deadline = time.monotonic() + wait
+    while True:
+        stats = next(
+            item for item in get_persist_stats() if item["path"] == os.path.abspath(path)
+        )
+        if stats["dirty_rows"] == 0 or time.monotonic() >= deadline:
+            return stats
+        time.sleep(0.05)
+
+
+def test_chroma_persists_after_interval(mocker, fresh_db):
+    """Unsaved rows are written once CHROMA_DB_PERSIST_INTERVAL has passed"""
+    mocker.patch("core.vectordb.chroma_clients.PERSIST_INTERVAL", 0.5)
+    path = fresh_db["dbPath"]
+    _add_unsaved_row(path, "first")
+    stats = _persist_stats(path)
+    assert (stats["dirty_rows"], stats["flushes"]) == (1, 0)
+    stats = _persist_stats(path, wait=5)
+    assert (stats["dirty_rows"], stats["flushes"]) == (0, 1)
+
+
+def test_chroma_persists_at_dirty_rows(mocker, fresh_db):
+    """Unsaved rows are written as soon as there are CHROMA_DB_PERSIST_DIRTY_ROWS"""
+    mocker.patch("core.vectordb.chroma_clients.PERSIST_INTERVAL", 3600)
+    mocker.patch("core.vectordb.chroma_clients.PERSIST_DIRTY_ROWS", 2)
+    path = fresh_db["dbPath"]
+    _add_unsaved_row(path, "first")
+    # More than a round of the flusher
+    stats = _persist_stats(path, wait=1.5)
+    assert (stats["dirty_rows"], stats["flushes"]) == (1, 0)
+    _add_unsaved_row(path, "second")
+    stats = _persist_stats(path, wait=5)
+    assert (stats["dirty_rows"], stats["flushes"]) == (0, 1)
+
+
+def test_chroma_persists_in_sync_mode(mocker, fresh_db):
+    """With CHROMA_DB_PERSIST_SYNC, every add is written right away"""
+    mocker.patch("core.vectordb.chroma_clients.PERSIST_INTERVAL", 3600)
+    mocker.patch("core.vectordb.chroma_clients.PERSIST_SYNC", True)
+    path = fresh_db["dbPath"]
+    _add_unsaved_row(path, "first")
+    stats = _persist_stats(path)
+    assert (stats["dirty_rows"], stats["flushes"]) == (0, 1)
+
+
+def test_chroma_persists_on_shutdown(mocker, fresh_db):
+    """close_all_clients writes the unsaved rows, so a new client finds them"""
+    mocker.patch("core.vectordb.chroma_clients.PERSIST_INTERVAL", 3600)
+    path = fresh_db["dbPath"]
+    _add_unsaved_row(path, "first")
+    close_all_clients()
+    assert not get_persist_stats()
+    handle = get_collection(None, None, path, "persisted")
+    assert handle.get(include=[])["ids"] == ["first"]
+
+
+def _retrieval_cache_hits() -> int:
+    """Hits of the retrieval cache so far"""
+    return retrieval_cache.get_stats()["hits"]
+
+
+def test_retrieval_cache_invalidated_by_upload(fresh_db):
+    """A repeated query is served from the retrieval cache till the collection is
+    written to, and then finds the new document"""
+    embedding = SentenceTransformerEmbedding()
+    store = Postgres(
+        embedding=embedding,
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible"],
+        max_cosine_distance=2,
+    )
+    docs = [schema.Document(**item) for item in SENT_DATA]
+    embedding.get_embeddings(docs)
+    store.add_to_collection(docs[:2])
+    query = "Let there be light"
+    first = store.get_relevant_documents(query)
+    assert "NIV GEN 1:3" not in {doc.metadata["source"] for doc in first}
+    hits = _retrieval_cache_hits()
+    assert store.get_relevant_documents(query) == first
+    assert _retrieval_cache_hits() == hits + 1
+    store.add_to_collection(docs[2:3])
+    results = store.get_relevant_documents(query)
+    assert _retrieval_cache_hits() == hits + 1
+    assert results[0].metadata["source"] == "NIV GEN 1:3"
+
+
+def test_retrieval_cache_key(fresh_db):
+    """Searches that differ in labels, search effort, search mode or metadata filter
+    are not served each other's cached results"""
+    embedding = SentenceTransformerEmbedding()
+    store = Postgres(
+        embedding=embedding,
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible"],
+        max_cosine_distance=2,
+    )
+    docs = [schema.Document(**item) for item in SENT_DATA]
+    embedding.get_embeddings(docs)
+    store.add_to_collection(docs)
+    query = "Let there be light"
+    store.get_relevant_documents(query)
+    hits = _retrieval_cache_hits()
+    other_label = Postgres(
+        embedding=embedding,
+        collection_name=fresh_db["collectionName"],
+        labels=["ESV bible"],
+        max_cosine_distance=2,
+    )
+    results = other_label.get_relevant_documents(query)
+    assert [doc.metadata["source"] for doc in results] == ["no records found"]
+    store.get_relevant_documents(query, search_effort=schema.SearchEffort.HIGH_RECALL)
+    store.get_relevant_documents(query, search_mode=schema.SearchMode.HYBRID)
+    store.get_relevant_documents(query, metadata_filter={"book": "GEN"})
+    assert _retrieval_cache_hits() == hits
+    store.get_relevant_documents(query)
+    assert _retrieval_cache_hits() == hits + 1
+
+
+def test_vector_index_endpoints(mocker, fresh_db):
+    """The index is built through the endpoint and swapped in under its name.
+    A request made while another process builds is turned away, and doesn't build"""
+    mocker.patch("core.vectordb.postgres_index.INDEX_AUTO_BUILD", False)
+    test_data_upload_processed_sentences(
+        mocker, schema.DatabaseType.POSTGRES, fresh_db
+    )
+    build = mocker.spy(postgres_index, "_build")
+    params = {
+        "token": ADMIN_TOKEN,
+        "collectionName": fresh_db["collectionName"],
+        "embeddingType": schema.EmbeddingType.HUGGINGFACE_DEFAULT.value,
+    }
+    response = client.get("/admin/vector-index", params=params)
+    assert response.status_code == 200, response.json()
+    assert not response.json()["exists"]
+
+    store = Postgres(
+        embedding=SentenceTransformerEmbedding(),
+        collection_name=fresh_db["collectionName"],
+    )
+    with store.pool.connection() as db_conn:
+        cur = db_conn.cursor()
+        # As another process building would
+        cur.execute(
+            "SELECT pg_advisory_lock(hashtext(%s))", (postgres_index.INDEX_NAME,)
+        )
+        response = client.post("/admin/vector-index", params=params)
+        cur.execute(
+            "SELECT pg_advisory_unlock(hashtext(%s))", (postgres_index.INDEX_NAME,)
+        )
+        cur.close()
+        db_conn.commit()
+    assert response.status_code == 200, response.json()
+    assert not response.json()["exists"]
+    assert build.call_count == 0
+
+    response = client.post("/admin/vector-index", params=params)
+    assert response.status_code == 200, response.json()
+    assert response.json()["exists"]
+    assert build.call_count == 1
+    with store.pool.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'embeddings' "
+            + "AND starts_with(indexname, %s)",
+            (postgres_index.INDEX_NAME,),
+        )
+        names = [row[0] for row in cur.fetchall()]
+        cur.close()
+        db_conn.commit()
+    assert names == [postgres_index.INDEX_NAME]
+
+
+def test_index_updates_are_merged(mocker):
+    """Updates scheduled while one is waiting are folded into it, with all their labels"""
+    mocker.patch("core.vectordb.postgres_index.INDEX_AUTO_BUILD", True)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def update(labels):
+        calls.append(set(labels))
+        started.set()
+        release.wait(5)
+
+    postgres_index.schedule_index_update("merged", ["first"], update)
+    assert started.wait(5)
+    postgres_index.schedule_index_update("merged", ["second"], update)
+    postgres_index.schedule_index_update("merged", ["third"], update)
+    release.set()
+    deadline = time.monotonic() + 5
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.1)
+    assert calls == [{"first"}, {"second", "third"}]
+
+
+def test_async_postgres_search(fresh_db):
+    """aget_relevant_documents searches on the asyncpg pool, with and without
+    a metadata filter, and finds what get_relevant_documents finds"""
+    embedding = SentenceTransformerEmbedding()
+    store = Postgres(
+        embedding=embedding,
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible"],
+        max_cosine_distance=2,
+    )
+    docs = [
+        schema.Document(**item, metadata={"verse": num})
+        for num, item in enumerate(SENT_DATA, start=1)
+    ]
+    embedding.get_embeddings(docs)
+    store.add_to_collection(docs)
+    query = "Let there be light"
+    results = asyncio.run(store.aget_relevant_documents(query))
+    assert results[0].metadata["source"] == "NIV GEN 1:3"
+    # Another effort, so that it isn't served from the retrieval cache
+    sync_results = store.get_relevant_documents(
+        query, search_effort=schema.SearchEffort.HIGH_RECALL
+    )
+    assert [doc.metadata["source"] for doc in sync_results] == [
+        doc.metadata["source"] for doc in results
+    ]
+    results = asyncio.run(
+        store.aget_relevant_documents(query, metadata_filter={"verse": {"$in": [1, 2]}})
+    )
+    assert {doc.metadata["source"] for doc in results} == {"NIV GEN 1:1", "NIV GEN 1:2"}
+
+
+def test_unknown_search_effort():
+    """A search effort that isn't one of schema.SearchEffort names the allowed ones"""
+    assert search_effort_setting("high-recall") == schema.SearchEffort.HIGH_RECALL
+    with pytest.raises(GenericException) as error:
+        search_effort_setting("thorough")
+    assert "fast, balanced, high-recall" in error.value.detail
+
+
+TOP_HIT_QUERIES = ["Let there be light", "the Spirit of God over the waters"]
+
+
+def _top_hits(store: Postgres, **kwargs) -> list:
+    """The source of the nearest document to each of TOP_HIT_QUERIES"""
+    return [
+        store.get_relevant_documents(query, **kwargs)[0].metadata["source"]
+        for query in TOP_HIT_QUERIES
+    ]
+
+
+def _indexed_store(fresh_db, **kwargs) -> tuple:
+    """A store of SENT_DATA among random rows of a filler label, and its top hits by
+    exact search. Then the vector index is built, so that searches go through it"""
+    embedding = SentenceTransformerEmbedding()
+    store = Postgres(
+        embedding=embedding,
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible", "filler"],
+        max_cosine_distance=2,
+        **kwargs,
+    )
+    docs = [schema.Document(**item) for item in SENT_DATA]
+    embedding.get_embeddings(docs)
+    rng = np.random.default_rng(0)
+    docs += [
+        schema.Document(
+            docId=f"filler {num}",
+            text=f"Filler {num}",
+            label="filler",
+            embedding=rng.standard_normal(store.dimension).tolist(),
+        )
+        for num in range(1000)
+    ]
+    store.add_to_collection(docs)
+    exact = _top_hits(store)
+    store.rebuild_index(force=True)
+    # Cached before the index was built
+    retrieval_cache.invalidate(store.collection_key)
+    return store, exact
+
+
+def test_search_efforts_match_exact(mocker, fresh_db):
+    """Every search effort finds the same nearest documents as exact search"""
+    mocker.patch("core.vectordb.postgres_index.INDEX_AUTO_BUILD", False)
+    store, exact = _indexed_store(fresh_db)
+    for effort in schema.SearchEffort:
+        assert _top_hits(store, search_effort=effort) == exact
+
+
+def test_label_indexes_match_exact(mocker, fresh_db):
+    """A search over per-label indexes finds the same nearest documents as exact search"""
+    mocker.patch("core.vectordb.postgres_index.INDEX_AUTO_BUILD", False)
+    store, exact = _indexed_store(fresh_db, label_indexes=True)
+    with store.pool.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'embeddings'")
+        names = {row[0] for row in cur.fetchall()}
+        cur.close()
+        db_conn.commit()
+    assert {
+        postgres_index.label_index_name(label, store.storage_mode) for label in store.labels
+    } <= names
+    assert _top_hits(store) == exact
+
+
+@pytest.mark.parametrize("storage_mode", ["halfvec", "binary"])
+def test_quantized_storage_matches_exact(mocker, fresh_db, storage_mode):
+    """Candidates found through a quantized index and re-ranked by their full vectors
+    are the same nearest documents as exact search finds"""
+    mocker.patch("core.vectordb.postgres_index.INDEX_AUTO_BUILD", False)
+    store, exact = _indexed_store(fresh_db, storage_mode=storage_mode)
+    assert postgres_index.indexed_storage_mode(store.collection_key) == storage_mode
+    assert _top_hits(store) == exact
+
+
+def test_prepared_statements_beyond_cache_size(mocker, fresh_db):
+    """With room for one prepared statement per connection, searches with different
+    statements back to back deallocate each other's, and still find their documents"""
+    mocker.patch("core.vectordb.postgres4langchain.PREPARED_STATEMENTS_MAX", 1)
+    embedding = SentenceTransformerEmbedding()
+    store = Postgres(
+        embedding=embedding,
+        collection_name=fresh_db["collectionName"],
+        labels=["NIV bible"],
+        max_cosine_distance=2,
+    )
+    docs = [schema.Document(**item) for item in SENT_DATA]
+    embedding.get_embeddings(docs)
+    store.add_to_collection(docs)
+    query = "Let there be light"
+    results = store.get_relevant_documents(query)
+    assert results[0].metadata["source"] == "NIV GEN 1:3"
+    results = store.get_relevant_documents(
+        "formless", search_mode=schema.SearchMode.HYBRID
+    )
+    assert results[0].metadata["source"] == "NIV GEN 1:2"
+    # The first statement again, with another effort so that it isn't served
+    # from the retrieval cache
+    results = store.get_relevant_documents(
+        query, search_effort=schema.SearchEffort.HIGH_RECALL
+    )
+    assert results[0].metadata["source"] == "NIV GEN 1:3"
+    with store.pool.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute("SELECT name FROM pg_prepared_statements")
+        names = {row[0] for row in cur.fetchall()}
+        cur.close()
+        db_conn.commit()
+        assert len(db_conn.prepared) <= 1
+        assert names == set(db_conn.prepared)
@@ -0,0 +1,254 @@
+"""Test the embedding implementations and the layers around them"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import openai
+import pytest
+from app import schema
+from core.embedding import EmbeddingInterface
+from core.embedding.cache import EmbeddingCache, CachedEmbedding
+from core.embedding.registry import ModelRegistry
+from core.embedding.batcher import EmbeddingBatcher, get_batcher
+from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.embedding.quantized import QuantizedSentenceTransformerEmbedding
+from core.embedding.openai import OpenAIEmbedding
+from core.embedding.worker_pool import ProcessPoolEmbedding, get_pool, shutdown_pools
+
+# pylint: disable=too-few-public-methods, super-init-not-called
+
+
+class CountingEmbedding(EmbeddingInterface):
+    """Fake backend that records which texts it was asked to embed"""
+
+    model_name = "counting-model"
+
+    def __init__(self):
+        """Starts with nothing seen"""
+        self.seen = []
+
+    def get_embeddings(self, doc_list):
+        """Records the texts and gives each a vector based on its length"""
+        for doc in doc_list:
+            self.seen.append(doc.text)
+            doc.embedding = [float(len(doc.text)), 1.0, 0.5]
+
+
+def test_embedding_cache_reuses_vectors(tmp_path):
+    """Unchanged texts should not be embedded again, even with formatting edits"""
+    backend = CountingEmbedding()
+    cache = EmbeddingCache(path=str(tmp_path), memory_items=2)
+    embedding = CachedEmbedding(backend, cache=cache)
+
+    docs = [
+        schema.Document(docId="1", text="In the beginning"),
+        schema.Document(docId="2", text="God created"),
+    ]
+    embedding.get_embeddings(docs)
+    assert backend.seen == ["In the beginning", "God created"]
+
+    edited = [
+        schema.Document(docId="1", text="In  the beginning\n"),
+        schema.Document(docId="2", text="God created"),
+        schema.Document(docId="3", text="the heavens and the earth"),
+    ]
+    embedding.get_embeddings(edited)
+    assert backend.seen[2:] == ["the heavens and the earth"]
+    assert list(edited[0].embedding) == list(docs[0].embedding)
+
+    # a fresh cache on the same folder serves from disk
+    disk_cache = EmbeddingCache(path=str(tmp_path))
+    key = disk_cache.make_key("counting-model", "God created")
+    assert list(disk_cache.get(key)) == [11.0, 1.0, 0.5]
+    assert disk_cache.get_stats()["disk_hits"] == 1
+
+
+def test_async_embedding_through_cache(tmp_path):
+    """aget_embeddings should give the same result as get_embeddings"""
+    backend = CountingEmbedding()
+    embedding = CachedEmbedding(backend, cache=EmbeddingCache(path=str(tmp_path)))
+    docs = [schema.Document(docId="1", text="grace"), schema.Document(docId="2", text="grace")]
+    asyncio.run(embedding.aget_embeddings(docs))
+    assert backend.seen == ["grace"]
+    assert list(docs[1].embedding) == [5.0, 1.0, 0.5]
+
+
+def test_embedding_cache_eviction(tmp_path):
+    """The disk tier should stay within its size cap"""
+    cache = EmbeddingCache(path=str(tmp_path), max_disk_bytes=100, memory_items=1)
+    for num in range(10):
+        cache.put(cache.make_key("model", str(num)), [0.1] * 4)
+    assert cache.get_stats()["disk_bytes"] <= 100
+    assert cache.get_stats()["evictions"] > 0
+
+
+def test_model_registry_shares_instances():
+    """Each model should be loaded once, and unpinned models reused while still in use"""
+    loads = []
+
+    class FakeModel:
+        """Stands in for a loaded model"""
+
+    def loader():
+        loads.append(1)
+        return FakeModel()
+
+    registry = ModelRegistry(max_models=1)
+    first = registry.get("model-a", loader)
+    assert registry.get("model-a", loader) is first
+    registry.get("model-b", loader)  # unpins model-a, but it is still referenced here
+    assert registry.get("model-a", loader) is first
+    assert len(loads) == 2
+
+
+def test_batcher_groups_concurrent_queries():
+    """Concurrent queries should be embedded together and each get its own vector"""
+    batch_sizes = []
+
+    class BatchRecordingEmbedding(CountingEmbedding):
+        """Records the size of every batch"""
+
+        def get_embeddings(self, doc_list):
+            batch_sizes.append(len(doc_list))
+            super().get_embeddings(doc_list)
+
+    batcher = EmbeddingBatcher(BatchRecordingEmbedding(), max_batch_size=8, max_wait_ms=50)
+    queries = ["a" * num for num in range(1, 9)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        vectors = list(executor.map(batcher.embed, queries))
+    assert [vector[0] for vector in vectors] == [float(num) for num in range(1, 9)]
+    assert sum(batch_sizes) == 8
+    assert len(batch_sizes) < 8
+
+
+def test_batchers_keyed_on_backend_settings(tmp_path):
+    """Wrapped backends that differ only in their key get batchers of their own"""
+
+    class KeyedEmbedding(CountingEmbedding):
+        """A backend with credentials"""
+
+        def __init__(self, api_key):
+            super().__init__()
+            self.api_key = api_key
+
+    cache = EmbeddingCache(path=str(tmp_path))
+    first = get_batcher(CachedEmbedding(KeyedEmbedding("key-1"), cache=cache))
+    same = get_batcher(CachedEmbedding(KeyedEmbedding("key-1"), cache=cache))
+    other = get_batcher(CachedEmbedding(KeyedEmbedding("key-2"), cache=cache))
+    assert same is first
+    assert other is not first
+    assert other.embedding.embedding.api_key == "key-2"
+
+
+def test_batcher_stops_when_idle():
+    """The worker thread stops without requests, and starts again for the next one"""
+    batcher = EmbeddingBatcher(CountingEmbedding(), max_wait_ms=0, idle_seconds=0.05)
+    assert batcher.embed("grace")[0] == 5.0
+    worker = batcher.worker
+    worker.join(timeout=5)
+    assert not worker.is_alive()
+    assert batcher.worker is None
+    assert batcher.embed("mercy")[0] == 5.0
+
+
+@pytest.mark.parametrize(
+    "model, dimension",
+    [("thenlper/gte-small", 384), ("sentence-transformers/LaBSE", 768)],
+)
+def test_quantized_embedding_parity(model, dimension):
+    """The int8 model should give vectors of the same size and direction as the fp32 one"""
+    texts = [
+        "In the beginning God created the heavens and the earth.",
+        "Melchizedek king of Salem brought out bread and wine.",
+        "An ephod is a garment worn by the priests.",
+    ]
+    fp32_docs = [schema.Document(docId=str(num), text=text) for num, text in enumerate(texts)]
+    int8_docs = [schema.Document(docId=str(num), text=text) for num, text in enumerate(texts)]
+    SentenceTransformerEmbedding(model=model).get_embeddings(fp32_docs)
+    QuantizedSentenceTransformerEmbedding(model=model).get_embeddings(int8_docs)
+    for fp32_doc, int8_doc in zip(fp32_docs, int8_docs):
+        fp32_vector = np.asarray(fp32_doc.embedding)
+        int8_vector = np.asarray(int8_doc.embedding)
+        assert int8_vector.shape == (dimension,)
+        similarity = np.dot(fp32_vector, int8_vector) / (
+            np.linalg.norm(fp32_vector) * np.linalg.norm(int8_vector)
+        )
+        assert similarity > 0.98
+
+
+def fake_openai_create(calls, failures):
+    """Stands in for openai.Embedding.create, raising the queued errors first"""
+
+    def create(input, model):  # pylint: disable=redefined-builtin, unused-argument
+        calls.append(list(input))
+        if failures:
+            raise failures.pop(0)
+        return {
+            "data": [
+                {"index": num, "embedding": [float(len(text))]}
+                for num, text in enumerate(input)
+            ]
+        }
+
+    return create
+
+
+def test_openai_embedding_retries_and_splits(mocker):
+    """A rate limit retries the whole batch, only rejected input splits it"""
+    mocker.patch("core.embedding.openai.time.sleep")
+    embedding = OpenAIEmbedding(key="test-key")
+    docs = [schema.Document(docId=str(num), text="x" * num) for num in range(1, 5)]
+
+    calls = []
+    mocker.patch(
+        "openai.Embedding.create",
+        fake_openai_create(calls, [openai.error.RateLimitError("Rate limit reached")]),
+    )
+    embedding.get_embeddings(docs)
+    assert len(calls) == 2
+    assert calls[0] == calls[1]
+    assert [doc.embedding for doc in docs] == [[1.0], [2.0], [3.0], [4.0]]
+
+    calls = []
+    mocker.patch(
+        "openai.Embedding.create",
+        fake_openai_create(
+            calls, [openai.error.InvalidRequestError("Input too long", "input")]
+        ),
+    )
+    embedding.get_embeddings(docs)
+    assert [len(call) for call in calls] == [4, 2, 2]
+    assert [doc.embedding for doc in docs] == [[1.0], [2.0], [3.0], [4.0]]
+
+
+def test_embedding_cache_overwrite_keeps_size(tmp_path):
+    """Storing a key again doesn't count its bytes twice"""
+    cache = EmbeddingCache(path=str(tmp_path), memory_items=2)
+    key = cache.make_key("counting-model", "In the beginning")
+    cache.put(key, [1.0, 2.0, 3.0])
+    cache.put(key, [1.0, 2.0, 3.0])
+    assert cache.get_stats()["disk_bytes"] == 3 * 4
+
+
+def test_worker_pools_keyed_on_worker_count():
+    """A pool asked for with another worker count should be a separate pool"""
+    try:
+        two_workers = get_pool("thenlper/gte-small", 2)
+        assert get_pool("thenlper/gte-small", 2) is two_workers
+        assert get_pool("thenlper/gte-small", 1) is not two_workers
+        assert two_workers._max_workers == 2  # pylint: disable=protected-access
+    finally:
+        shutdown_pools()
+
+
+def test_worker_pool_embedding_matches_in_process():
+    """Vectors made on the worker processes should match the in-process ones, in order"""
+    texts = ["In the beginning", "God created", "the heavens and the earth", "light", "day"]
+    pooled_docs = [schema.Document(docId=str(num), text=text) for num, text in enumerate(texts)]
+    local_docs = [schema.Document(docId=str(num), text=text) for num, text in enumerate(texts)]
+    try:
+        ProcessPoolEmbedding(workers=2, batch_size=2).get_embeddings(pooled_docs)
+    finally:
+        shutdown_pools()
+    SentenceTransformerEmbedding().get_embeddings(local_docs)
+    for pooled, local in zip(pooled_docs, local_docs):
+        assert np.allclose(pooled.embedding, local.embedding, atol=1e-5)
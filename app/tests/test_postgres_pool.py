@@ -0,0 +1,109 @@
+"""Test the postgres connection pool, with stand-in connections"""
+import psycopg2
+import psycopg2.extensions
+import pytest
+from core.vectordb.postgres_pool import ConnectionPool
+from custom_exceptions import PostgresException
+
+# pylint: disable=too-few-public-methods
+
+
+class FakeCursor:
+    """Cursor that fails every statement once its connection is broken"""
+
+    def __init__(self, conn):
+        """Belongs to conn"""
+        self.conn = conn
+
+    def execute(self, *_):
+        """Runs nothing, or fails like a dropped connection"""
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def close(self):
+        """Nothing to free"""
+
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection"""
+
+    def __init__(self):
+        """Open and working"""
+        self.closed = False
+        self.broken = False
+
+    def cursor(self):
+        """A cursor on this connection"""
+        return FakeCursor(self)
+
+    def rollback(self):
+        """Nothing to roll back"""
+
+    @staticmethod
+    def get_transaction_status():
+        """Never left in a transaction"""
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        """Marks it closed"""
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+    """Pool that opens stand-in connections and remembers them"""
+
+    def __init__(self, **kwargs):
+        """Same limits as ConnectionPool"""
+        super().__init__({}, **kwargs)
+        self.opened = []
+
+    def _connect(self):
+        """A new stand-in connection"""
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+
+def test_pool_times_out_when_exhausted():
+    """A checkout waits at most timeout seconds for a connection to be returned"""
+    pool = FakePool(min_size=0, max_size=1, timeout=0.1)
+    with pool.connection():
+        with pytest.raises(PostgresException) as error:
+            pool.getconn()
+        assert "No free connection" in error.value.detail
+    with pool.connection() as conn:
+        assert conn is pool.opened[0]
+
+
+def test_pool_replaces_broken_connection():
+    """A connection that fails its health check is closed and a new one handed out"""
+    pool = FakePool(min_size=0, max_size=1, check_after=0)
+    with pool.connection() as conn:
+        conn.broken = True
+    with pool.connection() as conn:
+        assert conn is pool.opened[1]
+    assert pool.opened[0].closed
+    assert pool.size == 1
+
+
+def test_pool_reaps_idle_connections():
+    """maintain closes connections idle for longer than max_idle, down to min_size"""
+    pool = FakePool(min_size=1, max_size=3, max_idle=0)
+    first, second = pool.getconn(), pool.getconn()
+    pool.putconn(first)
+    pool.putconn(second)
+    pool.maintain()
+    assert pool.size == 1
+    assert [conn.closed for conn in pool.opened] == [True, False]
+
+
+def test_closed_pool_refuses_checkouts():
+    """After closeall, the idle connections are closed and checkouts raise"""
+    pool = FakePool(min_size=1)
+    pool.fill()
+    pool.closeall()
+    assert pool.opened[0].closed
+    with pytest.raises(PostgresException) as error:
+        with pool.connection():
+            pass
+    assert "closed" in error.value.detail
@@ -0,0 +1,125 @@
+'''This script compares the storage modes of the Postgres vector store on the data
+already in a collection. For each mode it builds the matching ANN index, runs the
+same queries and reports recall@k against an exact search with full vectors,
+the p50/p95 latency and the size of the index.
+Queries are stored embeddings with a little noise added, so no embedding model is needed.
+Building the indexes of a large collection takes a while, and memory on the DB host,
+so better run this on a copy of the production database.
+Database: Postgres with pgvector 0.7 or later
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import psycopg2
+from pgvector.psycopg2 import register_vector
+
+# Add application directory to system path
+sys.path.append('../app')
+
+from core.vectordb.postgres_index import (
+    RERANK_FACTORS,
+    STORAGE_MODES,
+    index_expression,
+    index_params,
+)
+from core.vectordb.postgres4langchain import SEARCH_ARG_TYPES, search_query
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+parser.add_argument('--host', default=os.getenv('POSTGRES_DB_HOST', 'localhost'))
+parser.add_argument('--port', default=os.getenv('POSTGRES_DB_PORT', '5432'))
+parser.add_argument('--dbname', default=os.getenv('POSTGRES_DB_NAME', 'adotbcollection'))
+parser.add_argument('--user', default=os.getenv('POSTGRES_DB_USER', 'admin'))
+parser.add_argument('--password', default=os.getenv('POSTGRES_DB_PASSWORD', 'secret'))
+parser.add_argument('--queries', type=int, default=200, help='Number of queries')
+parser.add_argument('-k', type=int, default=10, help='Results per query')
+parser.add_argument('--index-type', default='hnsw', choices=['hnsw', 'ivfflat'])
+parser.add_argument('--modes', nargs='+', default=list(STORAGE_MODES), choices=STORAGE_MODES)
+args = parser.parse_args()
+
+db_conn = psycopg2.connect(
+    host=args.host, port=args.port, dbname=args.dbname, user=args.user, password=args.password
+)
+register_vector(db_conn)
+db_conn.autocommit = True
+cur = db_conn.cursor()
+
+cur.execute("SELECT COUNT(*) FROM embeddings")
+row_count = cur.fetchone()[0]
+cur.execute(
+    "SELECT atttypmod FROM pg_attribute "
+    "WHERE attrelid = 'embeddings'::regclass AND attname = 'embedding'"
+)
+dimension = cur.fetchone()[0]
+print(f"{row_count} rows of dimension {dimension}")
+
+# Queries: random stored vectors with some noise, so that the nearest rows are not trivial
+rng = np.random.default_rng(0)
+cur.execute("SELECT embedding FROM embeddings ORDER BY random() LIMIT %s", (args.queries,))
+queries = []
+for (vector,) in cur.fetchall():
+    noisy = vector + rng.normal(0, 0.01, size=vector.shape).astype(np.float32)
+    queries.append(noisy / np.linalg.norm(noisy))
+
+# Ground truth: exact distances over all rows, with the indexes turned off
+ground_truth = []
+cur.execute("BEGIN")
+cur.execute("SET LOCAL enable_indexscan = off")
+cur.execute("SET LOCAL enable_bitmapscan = off")
+for query in queries:
+    cur.execute(
+        "SELECT source_id FROM embeddings ORDER BY embedding <=> %s LIMIT %s", (query, args.k)
+    )
+    ground_truth.append({row[0] for row in cur.fetchall()})
+cur.execute("COMMIT")
+
+print(f"{'mode':<10}{'recall@' + str(args.k):>12}{'p50 ms':>10}{'p95 ms':>10}{'index MB':>12}")
+for mode in args.modes:
+    expression, opclass = index_expression(mode, dimension)
+    params = index_params(args.index_type, row_count)
+    index_name = f"benchmark_{mode}_idx"
+    cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+    cur.execute(
+        f"CREATE INDEX {index_name} ON embeddings USING {args.index_type} "
+        f"({expression} {opclass}) WITH ("
+        + ", ".join(f"{key} = {value}" for key, value in params.items())
+        + ")"
+    )
+    cur.execute("SELECT pg_relation_size(%s::regclass)", (index_name,))
+    index_mb = cur.fetchone()[0] / 1024 / 1024
+
+    candidates = args.k * RERANK_FACTORS[mode]
+    cur.execute(
+        f"PREPARE benchmark_{mode} ({', '.join(SEARCH_ARG_TYPES)}) AS "
+        + search_query(mode, dimension)
+    )
+    cur.execute("SELECT array_agg(DISTINCT label) FROM embeddings")
+    labels = cur.fetchone()[0]
+    cur.execute("SET hnsw.ef_search = %s", (max(40, candidates),))
+    cur.execute("SET ivfflat.probes = 10")
+
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, ground_truth):
+        start = time.perf_counter()
+        # A cut-off of 2, the largest cosine distance, so that only the ranking is compared
+        cur.execute(
+            f"EXECUTE benchmark_{mode} (%s, %s, %s, %s, %s)",
+            (labels, query, 2.0, args.k, candidates),
+        )
+        found = {row[0] for row in cur.fetchall()}
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(found & expected) / len(expected))
+
+    cur.execute(f"DEALLOCATE benchmark_{mode}")
+    cur.execute(f"DROP INDEX {index_name}")
+    print(
+        f"{mode:<10}{np.mean(recalls):>12.3f}{np.percentile(latencies, 50):>10.2f}"
+        f"{np.percentile(latencies, 95):>10.2f}{index_mb:>12.1f}"
+    )
+
+cur.close()
+db_conn.close()
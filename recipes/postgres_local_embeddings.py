@@ -51,9 +51,10 @@ data_stack.embedding.get_embeddings(doc_list=processed_documents)
 data_stack.vectordb.add_to_collection(docs=processed_documents)
 
 # Print some information about the data in the database
-cur = data_stack.vectordb.db_conn.cursor()
-cur.execute("SELECT * FROM embeddings")
-rows = cur.fetchall()
+with data_stack.vectordb.pool.connection() as db_conn:
+    cur = db_conn.cursor()
+    cur.execute("SELECT * FROM embeddings")
+    rows = cur.fetchall()
 print("First Row meta from DB", str(rows[0])[:80] + '...')
 print("Last Row meta from DB:", str(rows[-1])[:80] + '...')
 print("Total rows: ", len(rows))